@@ -0,0 +1,193 @@
+"""
+Catalog and search benchmark.
+
+Fills a throwaway ``surftg_bench`` database with synthetic channels and a
+playlist folder, then times the ``Database`` methods behind the channel,
+playlist and search pages and behind indexing:
+
+* ``list_tgfiles`` and ``get_dbFiles`` on the first and the last page,
+* ``search_tgfiles`` with one, two and three word queries,
+* ``add_btgfiles`` inserting new files and updating known ones,
+* ``reindex_channel`` over the whole channel with a few files gone and a
+  few new ones.
+
+Runs against a local mongod given with ``--mongo``. ``--mock`` runs on
+mongomock in-process instead (``pip install mongomock``, which needs
+pymongo < 4.11); it scans every document for every operation, so keep
+``--files`` in the low thousands there and only compare mock runs with
+mock runs.
+
+    python benchmarks/catalog_bench.py --mongo mongodb://127.0.0.1:27017 --files 100000 --save
+    python benchmarks/catalog_bench.py --mock --files 2000 --playlist-files 1000
+
+The ``surftg_bench`` database is dropped before and after the run unless
+``--keep`` is given; the bot's own database is never touched.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import Catalog, offline_env, percentiles, print_table, save_result  # noqa: E402
+
+offline_env()
+
+from pymongo import MongoClient, UpdateOne  # noqa: E402
+from pymongo.errors import PyMongoError  # noqa: E402
+
+from bot.helper.database import Database  # noqa: E402
+
+BENCH_DB = "surftg_bench"
+CHAT_ID = "-1001000000001"
+PER_PAGE = 50
+SEED_BATCH = 10000
+
+
+def connect(args) -> Database:
+    """A Database on the benchmark database instead of the configured one."""
+    if args.mock:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("--mock needs mongomock, pip install mongomock")
+        client = mongomock.MongoClient()
+        # add_btgfiles logs and swallows errors, an incompatible mongomock would time nothing
+        try:
+            client[BENCH_DB]["probe"].bulk_write([UpdateOne({"_id": 1}, {"$set": {"a": 1}}, upsert=True)])
+        except TypeError as e:
+            sys.exit(f"This mongomock does not work with the installed pymongo ({e}), use pymongo < 4.11 or --mongo")
+    else:
+        client = MongoClient(args.mongo, serverSelectionTimeoutMS=5000)
+        client.admin.command("ping")
+    db = Database()
+    db.mongo_client = client
+    db.db = client[BENCH_DB]
+    db.collection = db.db["playlist"]
+    db.config = db.db["config"]
+    db.files = db.db["files"]
+    return db
+
+
+async def measure(results: list, name: str, calls: int, call) -> None:
+    """Await ``call(n)`` ``calls`` times and add the latency percentiles to ``results``."""
+    samples = []
+    rows = 0
+    for n in range(calls):
+        started = perf_counter()
+        result = await call(n)
+        samples.append((perf_counter() - started) * 1000)
+        rows += len(result) if isinstance(result, list) else 0
+    logging.info(f"{name}: {calls} calls")
+    results.append({
+        "operation": name,
+        "calls": calls,
+        "rows": rows // calls if calls else 0,
+        **{f"{key}_ms": value for key, value in percentiles(samples).items()},
+        "max_ms": max(samples, default=None),
+    })
+
+
+def seed(db: Database, catalog: Catalog, args) -> dict:
+    started = perf_counter()
+    channels = {}
+    for n in range(args.channels):
+        chat_id = str(int(CHAT_ID) - n)
+        files = channels[chat_id] = catalog.files(chat_id, args.files)
+        for start in range(0, len(files), SEED_BATCH):
+            # Copies, insert_many adds an _id to what it is given
+            db.files.insert_many([dict(document) for document in files[start:start + SEED_BATCH]])
+    folder_id = str(db.collection.insert_one({"parent_folder": "root", "name": "Bench", "thumbnail": "", "type": "folder"}).inserted_id)
+    db.collection.insert_many(catalog.folders(folder_id, args.folders))
+    playlist = catalog.playlist_files(folder_id, CHAT_ID, args.playlist_files)
+    for start in range(0, len(playlist), SEED_BATCH):
+        db.collection.insert_many(playlist[start:start + SEED_BATCH])
+    logging.info(f"Seeded {args.channels} x {args.files} files and {args.playlist_files} playlist files in {perf_counter() - started:.1f}s")
+    return {"files": channels[CHAT_ID], "playlist": playlist, "folder_id": folder_id, "seconds": perf_counter() - started}
+
+
+async def run(db: Database, catalog: Catalog, data: dict, args) -> list:
+    results = []
+    files, playlist, folder_id = data["files"], data["playlist"], data["folder_id"]
+    last_page = max(1, -(-len(files) // PER_PAGE))
+    last_playlist_page = max(1, -(-len(playlist) // PER_PAGE))
+
+    await measure(results, "list_tgfiles first page", args.repeat, lambda n: db.list_tgfiles(id=CHAT_ID, page=1))
+    await measure(results, "list_tgfiles last page", args.repeat, lambda n: db.list_tgfiles(id=CHAT_ID, page=last_page))
+    await measure(results, "get_dbFiles first page", args.repeat, lambda n: db.get_dbFiles(folder_id, page=1))
+    await measure(results, "get_dbFiles last page", args.repeat, lambda n: db.get_dbFiles(folder_id, page=last_playlist_page))
+    for words in (1, 2, 3):
+        queries = [catalog.query(files, words) for _ in range(args.repeat)]
+        await measure(results, f"search_tgfiles {words} word{'s' if words > 1 else ''}", args.repeat, lambda n: db.search_tgfiles(id=CHAT_ID, query=queries[n]))
+    queries = [catalog.query(playlist, 2) for _ in range(args.repeat)]
+    await measure(results, "search_dbfiles 2 words", args.repeat, lambda n: db.search_dbfiles(folder_id, queries[n]))
+
+    next_msg_id = len(files) + 1
+    batches = []
+    for _ in range(args.upserts):
+        batches.append(catalog.files(CHAT_ID, args.batch, next_msg_id))
+        next_msg_id += args.batch
+    await measure(results, f"add_btgfiles insert {args.batch}", args.upserts, lambda n: db.add_btgfiles(batches[n]))
+    for batch in batches:
+        for document in batch:
+            document["title"] += " v2"
+    await measure(results, f"add_btgfiles update {args.batch}", args.upserts, lambda n: db.add_btgfiles(batches[n]))
+
+    channel = files + [document for batch in batches for document in batch]
+    snapshots = []
+    for _ in range(args.reindex_runs):
+        # About 1% of the files were deleted from the channel and 1% were posted since
+        kept = [document for document in channel if catalog.random.random() >= 0.01]
+        added = catalog.files(CHAT_ID, max(1, len(channel) // 100), next_msg_id)
+        next_msg_id += len(added)
+        channel = kept + added
+        snapshots.append(channel)
+    await measure(results, f"reindex_channel {len(channel)}", args.reindex_runs, lambda n: db.reindex_channel(CHAT_ID, snapshots[n]))
+    return results
+
+
+async def main(args) -> tuple:
+    try:
+        db = connect(args)
+    except PyMongoError as e:
+        sys.exit(f"Can not reach MongoDB at {args.mongo}: {e}")
+    db.mongo_client.drop_database(BENCH_DB)
+    catalog = Catalog(args.seed)
+    try:
+        data = seed(db, catalog, args)
+        return await run(db, catalog, data, args), data["seconds"]
+    finally:
+        if not args.keep:
+            db.mongo_client.drop_database(BENCH_DB)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    backend = parser.add_mutually_exclusive_group()
+    backend.add_argument("--mongo", default="mongodb://127.0.0.1:27017", help="MongoDB to create the benchmark database on")
+    backend.add_argument("--mock", action="store_true", help="use mongomock in-process instead of a MongoDB server")
+    parser.add_argument("--files", type=int, default=100000, help="files per channel")
+    parser.add_argument("--channels", type=int, default=1, help="channels in the files collection, only the first is queried")
+    parser.add_argument("--playlist-files", type=int, default=10000, help="files in the playlist folder")
+    parser.add_argument("--folders", type=int, default=50, help="subfolders of the playlist folder")
+    parser.add_argument("--repeat", type=int, default=20, help="calls of each listing and search")
+    parser.add_argument("--batch", type=int, default=1000, help="files per add_btgfiles call")
+    parser.add_argument("--upserts", type=int, default=5, help="add_btgfiles calls")
+    parser.add_argument("--reindex-runs", type=int, default=3, help="reindex_channel calls")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help=f"leave the {BENCH_DB} database behind")
+    parser.add_argument("--save", action="store_true", help="append the results to bench_results.jsonl")
+    parser.add_argument("--verbose", action="store_true", help="keep the log output")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    results, seeded = asyncio.run(main(args))
+    print_table(f"Catalog ({args.files} files, seeded in {seeded:.1f}s)", results)
+    if args.save:
+        params = {key: value for key, value in vars(args).items() if key not in ("save", "verbose", "keep")}
+        print(f"\nSaved to {save_result('catalog', params, {r['operation']: r for r in results})}")
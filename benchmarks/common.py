@@ -0,0 +1,168 @@
+"""
+Helpers shared by the benchmark scripts.
+
+``offline_env()`` must run before anything under ``bot`` is imported: the
+config, the pyrogram clients and the Mongo client are created at import time
+and would otherwise pick up a real ``config.env``.
+"""
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FILE = os.path.join(ROOT, "bench_results.jsonl")
+
+# Defaults only, anything already in the environment wins so settings like
+# PREFETCH_DEPTH or CHUNK_CACHE_SIZE can be compared between runs. The header
+# cache keeps its default and lives in the scratch directory
+OFFLINE_ENV = {
+    "API_ID": "1",
+    "API_HASH": "0" * 32,
+    "BOT_TOKEN": "1:offline",
+    # pymongo connects lazily, nothing is sent unless a benchmark asks for it
+    "DATABASE_URL": "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=1000",
+    "CHUNK_CACHE_SIZE": "0",
+    "SLOW_REQUEST_MS": "0",
+}
+
+
+def offline_env(**defaults: str) -> str:
+    """
+    Point the bot at nothing real and run from a scratch directory, so no
+    ``config.env`` is loaded and ``log.txt`` and the caches stay out of the
+    tree. Returns the scratch directory.
+    """
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    for key, value in {**OFFLINE_ENV, **defaults}.items():
+        os.environ.setdefault(key, value)
+    workdir = tempfile.mkdtemp(prefix="surf-bench-")
+    os.chdir(workdir)
+    return workdir
+
+
+QUALITIES = ["480p", "720p", "1080p", "2160p"]
+SOURCES = ["WEB DL", "WEBRip", "BluRay", "HDTV"]
+CODECS = ["x264", "x265", "HEVC", "AV1"]
+MIME_TYPES = ["video/x-matroska", "video/mp4", "video/webm"]
+
+
+class Catalog:
+    """
+    Synthetic channel contents shaped like what ``index_channel_files`` and
+    ``get_files`` produce. Titles are built from a fixed vocabulary of show
+    names, with a few shows holding most of the episodes as in real
+    channels, so searches for popular words return many results.
+    """
+
+    def __init__(self, seed: int = 0, shows: int = 2000):
+        self.random = random.Random(seed)
+        syllables = ["".join(self.random.choices(string.ascii_lowercase, k=self.random.randint(2, 4))) for _ in range(600)]
+        self.words = sorted({"".join(self.random.choices(syllables, k=self.random.randint(1, 3))) for _ in range(shows * 2)})
+        self.shows = [" ".join(self.random.sample(self.words, self.random.randint(1, 3))).title() for _ in range(shows)]
+
+    def title(self) -> str:
+        show = self.shows[min(int(self.random.paretovariate(1.2)) - 1, len(self.shows) - 1)]
+        episode = f"S{self.random.randint(1, 12):02d}E{self.random.randint(1, 24):02d}"
+        return f"{show} {episode} {self.random.choice(QUALITIES)} {self.random.choice(SOURCES)} {self.random.choice(CODECS)}"
+
+    def unique_hash(self) -> str:
+        return "".join(self.random.choices(string.ascii_letters + string.digits + "-_", k=6))
+
+    def size(self) -> str:
+        from bot.helper.file_size import get_readable_file_size
+        return get_readable_file_size(self.random.randint(50, 4000) * 1024 * 1024)
+
+    def files(self, chat_id: str, count: int, first_msg_id: int = 1) -> List[dict]:
+        """Documents as stored in the ``files`` collection."""
+        return [{
+            "chat_id": chat_id,
+            "msg_id": msg_id,
+            "hash": self.unique_hash(),
+            "title": self.title(),
+            "size": self.size(),
+            "type": self.random.choice(MIME_TYPES),
+        } for msg_id in range(first_msg_id, first_msg_id + count)]
+
+    def playlist_files(self, folder_id: str, chat_id: str, count: int) -> List[dict]:
+        """Documents as ``send_route`` adds them to the ``playlist`` collection."""
+        return [{
+            "chat_id": chat_id,
+            "parent_folder": folder_id,
+            "file_id": str(file_id),
+            "hash": self.unique_hash(),
+            "name": self.title(),
+            "size": self.size(),
+            "file_type": self.random.choice(MIME_TYPES),
+            "thumbnail": f"/api/thumb/{chat_id[4:]}?id={file_id}",
+            "type": "file",
+        } for file_id in range(1, count + 1)]
+
+    def folders(self, parent_id: str, count: int) -> List[dict]:
+        return [{"parent_folder": parent_id, "name": self.shows[n % len(self.shows)], "thumbnail": "", "type": "folder"} for n in range(count)]
+
+    def query(self, files: List[dict], words: int) -> str:
+        """``words`` consecutive words of a random title, so the search has hits."""
+        document = self.random.choice(files)
+        parts = (document.get("title") or document.get("name")).split()
+        start = self.random.randrange(0, max(1, len(parts) - words + 1))
+        return " ".join(parts[start:start + words]).lower()
+
+
+def percentiles(samples: List[float], points=(50, 95, 99)) -> Dict[str, Optional[float]]:
+    ordered = sorted(samples)
+    result = {}
+    for point in points:
+        if not ordered:
+            result[f"p{point}"] = None
+            continue
+        rank = min(len(ordered) - 1, max(0, round(point / 100 * len(ordered)) - 1))
+        result[f"p{point}"] = ordered[rank]
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save_result(benchmark: str, params: dict, metrics: dict, path: Optional[str] = None) -> str:
+    """Append one run to the results file so runs can be compared across releases."""
+    path = path or RESULTS_FILE
+    record = {
+        "benchmark": benchmark,
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "params": params,
+        "metrics": metrics,
+    }
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    return path
+
+
+def print_table(title: str, rows: List[Dict[str, object]]) -> None:
+    if not rows:
+        return
+    columns = list(rows[0])
+    widths = {column: max(len(column), *(len(format_cell(row[column])) for row in rows)) for column in columns}
+    print(f"\n{title}")
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(format_cell(row[column]).ljust(widths[column]) for column in columns))
+
+
+def format_cell(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return "-" if value is None else str(value)
@@ -0,0 +1,226 @@
+"""
+Page rendering benchmark.
+
+Renders the home, channel, playlist and search pages with 50, 1000 and
+10000 items from mocked data sources: the ``Database`` methods return
+synthetic documents from memory and ``StreamBot.get_chat`` a fake chat, so
+only the web layer is measured. Each page is timed at three levels:
+
+* ``cards``: the card builder alone (``posts_file``, ``posts_db_file``,
+  ``post_playlist`` and ``posts_chat``),
+* ``page``: the cards plus ``render_page`` filling the template,
+* ``http``: a GET of the real route through aiohttp, session and
+  middlewares included.
+
+Reported per page and size: time per render, the peak of Python
+allocations while rendering (tracemalloc, measured in a separate pass so it
+does not slow the timings) and the bytes of HTML produced.
+
+    python benchmarks/render_bench.py
+    python benchmarks/render_bench.py --items 1000 --pages search --level http --save
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import ROOT, Catalog, offline_env, percentiles, print_table, save_result  # noqa: E402
+
+offline_env()
+
+from aiohttp import ClientSession, CookieJar  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from bot.config import Telegram  # noqa: E402
+from bot.helper.chats import post_playlist, posts_chat, posts_db_file  # noqa: E402
+from bot.helper.database import Database  # noqa: E402
+from bot.helper.index import posts_file  # noqa: E402
+from bot.server import web_server  # noqa: E402
+from bot.server.render_template import render_page  # noqa: E402
+from bot.telegram import StreamBot  # noqa: E402
+
+# Templates are opened relative to the repository root
+os.chdir(ROOT)
+
+CHAT_ID = "-1001000000001"
+FOLDER_ID = "64b000000000000000000001"
+CHANNELS = 10
+SUBFOLDERS = 10
+
+
+class MockSource:
+    """In-memory stand-in for the Database methods and StreamBot.get_chat the pages call."""
+
+    def __init__(self, catalog: Catalog, items: int):
+        self.channels = [str(int(CHAT_ID) - n) for n in range(CHANNELS)]
+        self.files = catalog.files(CHAT_ID, items)
+        self.folders = [{"_id": f"64b{n:021d}", **folder} for n, folder in enumerate(catalog.folders("root", items))]
+        self.subfolders = [{"_id": f"64c{n:021d}", **folder} for n, folder in enumerate(catalog.folders(FOLDER_ID, SUBFOLDERS))]
+        self.playlist = [{"_id": f"64d{n:021d}", **document} for n, document in enumerate(catalog.playlist_files(FOLDER_ID, CHAT_ID, items))]
+
+    def install(self) -> None:
+        Database.get_variable = self.get_variable
+        Database.get_Dbfolder = self.get_Dbfolder
+        Database.get_dbFiles = self.get_dbFiles
+        Database.get_info = self.get_info
+        Database.list_tgfiles = self.list_tgfiles
+        Database.search_tgfiles = self.search_tgfiles
+        StreamBot.get_chat = self.get_chat
+
+    async def get_variable(self, key):
+        return {"theme": Telegram.THEME, "auth_channel": ",".join(self.channels)}.get(key)
+
+    async def get_Dbfolder(self, parent_id="root", page=1, per_page=50):
+        return self.folders if parent_id == "root" else self.subfolders
+
+    async def get_dbFiles(self, parent_id=None, page=1, per_page=50):
+        return self.playlist
+
+    async def get_info(self, id):
+        return "Bench"
+
+    async def list_tgfiles(self, id, page=1, per_page=50):
+        return self.files
+
+    async def search_tgfiles(self, id, query, page=1, per_page=1000):
+        return self.files
+
+    async def get_chat(self, chat_id):
+        return SimpleNamespace(id=chat_id, title=f"Channel {chat_id}", first_name=None, type=SimpleNamespace(name="CHANNEL"))
+
+
+def builders(source: MockSource) -> dict:
+    """Per page, the card builder and the render_page call that wraps its output, as the routes do."""
+    channel_id = CHAT_ID.replace("-100", "")
+    channels = [{"chat-id": int(chat_id), "title": f"Channel {chat_id}", "type": "CHANNEL"} for chat_id in source.channels]
+
+    async def home_cards():
+        return await posts_chat(channels), await post_playlist(source.folders)
+
+    async def home_page():
+        html, playlist = await home_cards()
+        return await render_page(None, None, route="home", html=html, playlist=playlist)
+
+    async def channel_cards():
+        return await posts_file(source.files, CHAT_ID)
+
+    async def channel_page():
+        return await render_page(None, None, route="index", html=await channel_cards(), msg="Bench", chat_id=channel_id)
+
+    async def playlist_cards():
+        return await post_playlist(source.subfolders), await posts_db_file(source.playlist)
+
+    async def playlist_page():
+        playlist, database = await playlist_cards()
+        return await render_page(FOLDER_ID, None, route="playlist", playlist=playlist, database=database, msg="Bench")
+
+    async def search_page():
+        return await render_page(None, None, route="index", html=await channel_cards(), msg="Bench - bench", chat_id=channel_id)
+
+    return {
+        "home": (home_cards, home_page, "/"),
+        "channel": (channel_cards, channel_page, f"/channel/{channel_id}"),
+        "playlist": (playlist_cards, playlist_page, f"/playlist?db={FOLDER_ID}"),
+        "search": (channel_cards, search_page, f"/search/{channel_id}?q=bench"),
+    }
+
+
+def output_size(result) -> int:
+    if isinstance(result, tuple):
+        return sum(output_size(part) for part in result)
+    return len(result.encode() if isinstance(result, str) else result)
+
+
+async def measure(render, args) -> dict:
+    """Time ``render`` for at least three calls and up to ``--repeat`` calls or ``--budget`` seconds, then trace one call."""
+    samples = []
+    started = perf_counter()
+    while len(samples) < 3 or (len(samples) < args.repeat and perf_counter() - started < args.budget):
+        call_started = perf_counter()
+        result = await render()
+        samples.append((perf_counter() - call_started) * 1000)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    await render()
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    timings = percentiles(samples, (50, 95))
+    return {
+        "calls": len(samples),
+        "p50_ms": timings["p50"],
+        "p95_ms": timings["p95"],
+        "peak_alloc_kib": round(peak / 1024, 1),
+        "html_kib": round(output_size(result) / 1024, 1),
+    }
+
+
+async def login(session: ClientSession, server: TestServer) -> None:
+    form = {"username": Telegram.USERNAME, "password": Telegram.PASSWORD}
+    async with session.post(server.make_url("/login"), data=form, allow_redirects=False) as response:
+        if response.status != 302:
+            raise RuntimeError(f"Login failed with status {response.status}")
+
+
+async def main(args) -> list:
+    results = []
+    server = session = None
+    if "http" in args.level:
+        server = TestServer(await web_server())
+        await server.start_server()
+        # Cookies of 127.0.0.1 are only kept by an unsafe jar
+        session = ClientSession(cookie_jar=CookieJar(unsafe=True))
+        await login(session, server)
+    try:
+        for items in args.items:
+            source = MockSource(Catalog(args.seed), items)
+            source.install()
+            for page, (cards, render, path) in builders(source).items():
+                if page not in args.pages:
+                    continue
+
+                async def http():
+                    async with session.get(server.make_url(path)) as response:
+                        if response.status != 200:
+                            raise RuntimeError(f"GET {path} returned {response.status}")
+                        return await response.read()
+
+                for level, call in (("cards", cards), ("page", render), ("http", http)):
+                    if level in args.level:
+                        logging.info(f"Rendering {page} at {items} items, {level}")
+                        results.append({"page": page, "items": items, "level": level, **await measure(call, args)})
+    finally:
+        if session is not None:
+            await session.close()
+            await server.close()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--items", type=int, nargs="+", default=[50, 1000, 10000], help="items per page")
+    parser.add_argument("--pages", nargs="+", choices=["home", "channel", "playlist", "search"], default=["home", "channel", "playlist", "search"])
+    parser.add_argument("--level", nargs="+", choices=["cards", "page", "http"], default=["cards", "page", "http"])
+    parser.add_argument("--repeat", type=int, default=50, help="most renders timed per page")
+    parser.add_argument("--budget", type=float, default=2, help="seconds of timed renders per page, after the first three")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", action="store_true", help="append the results to bench_results.jsonl")
+    parser.add_argument("--verbose", action="store_true", help="keep the log output")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    results = asyncio.run(main(args))
+    print_table("Rendering", results)
+    if args.save:
+        params = {key: value for key, value in vars(args).items() if key not in ("save", "verbose")}
+        metrics = {f"{r['page']} {r['items']} {r['level']}": r for r in results}
+        print(f"\nSaved to {save_result('render', params, metrics)}")
@@ -0,0 +1,381 @@
+"""
+Offline streaming benchmark.
+
+Serves synthetic files through the real aiohttp routes (``stream_handler``,
+admission, ``ByteStreamer``, the client scheduler and the session pools),
+with every pyrogram Session replaced by a fake one that answers
+upload.GetFile locally. Each fake DC adds its own round-trip latency, each
+bot downloads through one link of ``--bandwidth`` MiB/s shared by all its
+sessions, and FloodWaits and timeouts are injected at the given rates.
+Nothing leaves the machine.
+
+Workloads:
+
+* ``sequential``: every viewer plays a whole file from the start.
+* ``seeks``: every viewer jumps to ``--seeks`` random offsets and reads
+  ``--seek-read`` KiB at each, the way a player scrubs through a video.
+* ``parallel``: every viewer downloads a file as ``--parts`` concurrent
+  ranges, like a download manager.
+
+Reported per workload: throughput, time to first byte percentiles, failed
+and turned away (503) requests, GetFile calls and injected faults, peak RSS
+and the peak of the stream memory budget.
+
+    python benchmarks/stream_bench.py
+    python benchmarks/stream_bench.py --bots 4 --dcs 1:40,2:180,4:220 --flood-rate 0.01
+    PREFETCH_DEPTH=8 python benchmarks/stream_bench.py --workload sequential --save
+
+Settings from ``bot/config.py`` are read from the environment as usual, so
+two runs with different values can be compared. ``--save`` appends the run
+to ``bench_results.jsonl`` in the repository root.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import offline_env, percentiles, print_table, save_result  # noqa: E402
+
+offline_env()
+
+from aiohttp import ClientError, ClientSession, ClientTimeout  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+from pyrogram import raw  # noqa: E402
+from pyrogram.errors import FloodWait  # noqa: E402
+from pyrogram.file_id import FileId, FileType  # noqa: E402
+
+from bot.server import web_server  # noqa: E402
+from bot.server.custom_dl import ByteStreamer, class_cache  # noqa: E402
+from bot.server.file_cache import FileEntry, file_cache  # noqa: E402
+from bot.server.stream_engine import memory_budget  # noqa: E402
+from bot.telegram import multi_clients, work_loads  # noqa: E402
+
+MiB = 1024 * 1024
+CHAT_ID = 1000000001
+READ_SIZE = 256 * 1024
+# Twice the largest GetFile limit, so any request is one slice of it
+PATTERN = random.Random(0).randbytes(2 * MiB)
+
+
+def content(media_id: int, offset: int, length: int) -> bytes:
+    """Bytes ``offset`` to ``offset + length`` of a synthetic file, never crossing a 1 MiB boundary."""
+    start = media_id * 4099 % MiB + offset % MiB
+    return PATTERN[start:start + length]
+
+
+class Stats:
+    def __init__(self):
+        self.getfile = 0
+        self.floods = 0
+        self.timeouts = 0
+
+
+class FakeNetwork:
+    """Latency per DC and one download link per bot, shared by all of its sessions."""
+
+    def __init__(self, latency: dict, bandwidth: float, flood_rate: float, flood_wait: int, error_rate: float, seed: int):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.flood_rate = flood_rate
+        self.flood_wait = flood_wait
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.link_free = {}
+        self.stats = Stats()
+
+    async def transfer(self, bot: int, dc_id: int, nbytes: int) -> None:
+        loop = asyncio.get_running_loop()
+        rtt = self.latency[dc_id] * self.random.uniform(0.8, 1.2)
+        # Bytes queue behind whatever the bot's link is already carrying
+        start = max(loop.time() + rtt / 2, self.link_free.get(bot, 0.0))
+        done = start + nbytes / self.bandwidth
+        self.link_free[bot] = done
+        await asyncio.sleep(done + rtt / 2 - loop.time())
+
+    def fault(self):
+        roll = self.random.random()
+        if roll < self.flood_rate:
+            self.stats.floods += 1
+            return FloodWait(value=self.flood_wait)
+        if roll < self.flood_rate + self.error_rate:
+            self.stats.timeouts += 1
+            return TimeoutError()
+        return None
+
+
+class FakeSession:
+    def __init__(self, network: FakeNetwork, bot: int, dc_id: int, files: dict):
+        self.network = network
+        self.bot = bot
+        self.dc_id = dc_id
+        self.files = files
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def send(self, query):
+        if isinstance(query, raw.functions.Ping):
+            return raw.types.Pong(msg_id=0, ping_id=query.ping_id)
+        if not isinstance(query, raw.functions.upload.GetFile):
+            raise NotImplementedError(type(query).__name__)
+        self.network.stats.getfile += 1
+        if error := self.network.fault():
+            await asyncio.sleep(self.network.latency[self.dc_id])
+            raise error
+        media_id = query.location.id
+        length = max(0, min(query.limit, self.files[media_id] - query.offset))
+        await self.network.transfer(self.bot, self.dc_id, length)
+        return raw.types.upload.File(type=raw.types.storage.FileUnknown(), mtime=0, bytes=content(media_id, query.offset, length))
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+
+class FakeClient:
+    def __init__(self, index: int):
+        self.me = FakeUser(100000 + index)
+
+
+class FakeStreamer(ByteStreamer):
+    network: FakeNetwork = None
+    files: dict = {}
+
+    async def generate_media_session(self, dc_id: int):
+        return FakeSession(self.network, self.index, dc_id, self.files)
+
+
+def setup_files(args, dc_ids: list) -> list:
+    """Put every file in the file cache, with a file_id per bot, as if all bots had resolved it."""
+    files = []
+    for n in range(args.files):
+        message_id = n + 1
+        media_id = 5000000000 + n
+        dc_id = dc_ids[n % len(dc_ids)]
+        size = args.file_size * MiB - n * 12345
+        unique_id = f"bench{n:06d}"
+        file_ids = {
+            str(client.me.id): FileId(file_type=FileType.VIDEO, dc_id=dc_id, media_id=media_id, access_hash=n, file_reference=b"").encode()
+            for client in multi_clients.values()
+        }
+        file_cache.put(int(f"-100{CHAT_ID}"), message_id, FileEntry(f"bench{n}.mp4", size, "video/mp4", unique_id, 0, file_ids))
+        FakeStreamer.files[media_id] = size
+        files.append((message_id, media_id, size, unique_id[:6]))
+    return files
+
+
+class Workload:
+    def __init__(self, session: ClientSession, server: TestServer, verify: bool):
+        self.session = session
+        self.server = server
+        self.verify = verify
+        self.ttfb = []
+        self.bytes = 0
+        self.requests = 0
+        self.errors = 0
+        self.overloaded = 0
+
+    async def fetch(self, file, start: int, end: int, header: str = None) -> None:
+        """GET a file with the ``header`` Range and read bytes ``start`` to ``end``, hanging up after them like a player."""
+        message_id, media_id, size, secure_hash = file
+        headers = {"Range": header} if header else {}
+        url = self.server.make_url(f"/{CHAT_ID}/bench.mp4?id={message_id}&hash={secure_hash}")
+        self.requests += 1
+        sent = perf_counter()
+        received = 0
+        try:
+            async with self.session.get(url, headers=headers) as response:
+                if response.status == 503:
+                    self.overloaded += 1
+                    return
+                if response.status not in (200, 206):
+                    self.errors += 1
+                    return
+                wanted = end - start + 1
+                async for data in response.content.iter_chunked(READ_SIZE):
+                    if not received:
+                        self.ttfb.append(perf_counter() - sent)
+                    data = data[:wanted - received]
+                    if self.verify and not self.matches(media_id, start + received, data):
+                        logging.error(f"Wrong bytes for {media_id} at {start + received}")
+                        self.errors += 1
+                        return
+                    received += len(data)
+                    if received >= wanted:
+                        break
+            if received < wanted:
+                self.errors += 1
+        except (ClientError, asyncio.TimeoutError) as e:
+            logging.debug(f"Request for {media_id} failed: {e!r}")
+            self.errors += 1
+        finally:
+            self.bytes += received
+
+    @staticmethod
+    def matches(media_id: int, offset: int, data: bytes) -> bool:
+        view = memoryview(data)
+        position = 0
+        while position < len(view):
+            length = min(len(view) - position, MiB - (offset + position) % MiB)
+            if view[position:position + length] != content(media_id, offset + position, length):
+                return False
+            position += length
+        return True
+
+
+async def sequential(workload: Workload, files: list, args, rng: random.Random) -> None:
+    async def viewer(n: int):
+        file = files[n % len(files)]
+        await workload.fetch(file, 0, file[2] - 1)
+    await asyncio.gather(*[viewer(n) for n in range(args.viewers)])
+
+
+async def seeks(workload: Workload, files: list, args, rng: random.Random) -> None:
+    async def viewer(n: int):
+        file = files[n % len(files)]
+        for _ in range(args.seeks):
+            start = rng.randrange(0, file[2])
+            await workload.fetch(file, start, min(start + args.seek_read * 1024, file[2]) - 1, f"bytes={start}-")
+    await asyncio.gather(*[viewer(n) for n in range(args.viewers)])
+
+
+async def parallel(workload: Workload, files: list, args, rng: random.Random) -> None:
+    async def viewer(n: int):
+        file = files[n % len(files)]
+        part = -(-file[2] // args.parts)
+        ranges = [(start, min(start + part, file[2]) - 1) for start in range(0, file[2], part)]
+        await asyncio.gather(*[workload.fetch(file, start, end, f"bytes={start}-{end}") for start, end in ranges])
+    await asyncio.gather(*[viewer(n) for n in range(args.viewers)])
+
+
+WORKLOADS = {"sequential": sequential, "seeks": seeks, "parallel": parallel}
+
+
+def rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+async def run(name: str, session: ClientSession, server: TestServer, files: list, args) -> dict:
+    network = FakeStreamer.network
+    before = (network.stats.getfile, network.stats.floods, network.stats.timeouts)
+    workload = Workload(session, server, not args.no_verify)
+    peaks = {"rss": rss(), "budget": memory_budget.used}
+
+    async def sample():
+        while True:
+            peaks["rss"] = max(peaks["rss"], rss())
+            peaks["budget"] = max(peaks["budget"], memory_budget.used)
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample())
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = perf_counter()
+    await WORKLOADS[name](workload, files, args, random.Random(args.seed))
+    elapsed = perf_counter() - started
+    sampler.cancel()
+    traced = None
+    if args.tracemalloc:
+        traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    ttfb = {key: value * 1000 if value is not None else None for key, value in percentiles(workload.ttfb).items()}
+    return {
+        "workload": name,
+        "requests": workload.requests,
+        "mib": round(workload.bytes / MiB, 1),
+        "seconds": round(elapsed, 3),
+        "mib_s": round(workload.bytes / MiB / elapsed, 2),
+        "ttfb_p50_ms": ttfb["p50"],
+        "ttfb_p95_ms": ttfb["p95"],
+        "ttfb_p99_ms": ttfb["p99"],
+        "errors": workload.errors,
+        "overloaded": workload.overloaded,
+        "getfile": network.stats.getfile - before[0],
+        "floods": network.stats.floods - before[1],
+        "timeouts": network.stats.timeouts - before[2],
+        "peak_rss_mib": round(peaks["rss"] / MiB, 1),
+        "peak_budget_mib": round(peaks["budget"] / MiB, 1),
+        "peak_traced_mib": round(traced / MiB, 1) if traced is not None else None,
+    }
+
+
+def parse_dcs(value: str) -> dict:
+    """``1:40,4:200`` -> {1: 0.04, 4: 0.2}, round trip times in milliseconds."""
+    latency = {}
+    for item in value.split(","):
+        dc_id, ms = item.split(":")
+        latency[int(dc_id)] = int(ms) / 1000
+    return latency
+
+
+async def main(args) -> list:
+    FakeStreamer.network = FakeNetwork(args.dcs, args.bandwidth * MiB, args.flood_rate, args.flood_wait, args.error_rate, args.seed)
+    for index in range(args.bots):
+        client = multi_clients[index] = FakeClient(index)
+        work_loads[index] = 0
+        class_cache[client] = FakeStreamer(client, index)
+    files = setup_files(args, list(args.dcs))
+
+    server = TestServer(await web_server())
+    await server.start_server()
+    results = []
+    try:
+        async with ClientSession(timeout=ClientTimeout(total=args.timeout)) as session:
+            for name in (WORKLOADS if args.workload == "all" else [args.workload]):
+                results.append(await run(name, session, server, files, args))
+    finally:
+        await server.close()
+        for streamer in class_cache.values():
+            for media_pool in streamer.media_pools.values():
+                await media_pool.close()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--workload", choices=["all", *WORKLOADS], default="all")
+    parser.add_argument("--bots", type=int, default=2, help="clients in multi_clients")
+    parser.add_argument("--dcs", type=parse_dcs, default="1:40,2:150,4:200", help="DC:round trip ms, files are spread over these DCs")
+    parser.add_argument("--bandwidth", type=float, default=40, help="download link of each bot, MiB/s")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of GetFile calls answered with a FloodWait")
+    parser.add_argument("--flood-wait", type=int, default=1, help="seconds in each injected FloodWait")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of GetFile calls that time out")
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--file-size", type=int, default=32, help="MiB")
+    parser.add_argument("--viewers", type=int, default=8, help="concurrent viewers")
+    parser.add_argument("--seeks", type=int, default=8, help="seeks per viewer")
+    parser.add_argument("--seek-read", type=int, default=1024, help="KiB read after each seek")
+    parser.add_argument("--parts", type=int, default=4, help="concurrent ranges per viewer in the parallel workload")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds allowed per request")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-verify", action="store_true", help="skip checking the bytes received")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report the peak of Python allocations (slow)")
+    parser.add_argument("--save", action="store_true", help="append the results to bench_results.jsonl")
+    parser.add_argument("--verbose", action="store_true", help="keep the server's log output")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.CRITICAL)
+    results = asyncio.run(main(args))
+    print_table("Streaming", results)
+    if args.save:
+        params = {key: value for key, value in vars(args).items() if key not in ("save", "verbose")}
+        print(f"\nSaved to {save_result('stream', params, {r['workload']: r for r in results})}")
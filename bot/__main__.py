@@ -8,6 +8,8 @@ from bot.config import Telegram
 from bot.server import web_server
 from bot.telegram import StreamBot, UserBot
 from bot.telegram.clients import initialize_clients
+from bot.helper.index import get_catalog_dcs
+from bot.server.custom_dl import prewarm_media_sessions
 from bot.telegram import start
 
 loop = get_event_loop()
@@ -28,6 +30,17 @@ async def start_services():
     LOGGER.info("Initializing Multi Clients")
     await initialize_clients()
 
+    if Telegram.PREWARM_SESSIONS:
+        LOGGER.info("Pre-warming Media Sessions")
+        if Telegram.PREWARM_SESSIONS == 'catalog':
+            dc_ids = await get_catalog_dcs()
+        elif Telegram.PREWARM_SESSIONS == 'all':
+            dc_ids = [1, 2, 3, 4, 5]
+        else:
+            dc_ids = [int(dc_id) for dc_id in Telegram.PREWARM_SESSIONS.split(',') if dc_id.strip()]
+        await prewarm_media_sessions(dc_ids)
+        LOGGER.info(f"Media Sessions ready for DC {dc_ids}")
+
     await asleep(2)
     LOGGER.info('Initalizing Surf Web Server..')
     server = web.AppRunner(await web_server())
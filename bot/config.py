@@ -23,3 +23,31 @@ class Telegram:
     WORKERS = int(getenv('WORKERS', '10'))
     MULTI_CLIENT = getenv('MULTI_CLIENT', 'False')
     HIDE_CHANNEL = getenv('HIDE_CHANNEL', 'False')
+    PREFETCH_DEPTH = int(getenv('PREFETCH_DEPTH', '4'))
+    CHUNK_CACHE_SIZE = int(getenv('CHUNK_CACHE_SIZE', '0'))
+    CHUNK_CACHE_DIR = getenv('CHUNK_CACHE_DIR', 'cache/chunks')
+    HEADER_CACHE_SIZE = int(getenv('HEADER_CACHE_SIZE', '0'))
+    HEADER_CACHE_DIR = getenv('HEADER_CACHE_DIR', 'cache/headers')
+    STRIPE_CLIENTS = int(getenv('STRIPE_CLIENTS', '1'))
+    MEDIA_SESSIONS = int(getenv('MEDIA_SESSIONS', '2'))
+    MEDIA_SESSION_REQUESTS = int(getenv('MEDIA_SESSION_REQUESTS', '16'))
+    MEDIA_SESSION_PING = int(getenv('MEDIA_SESSION_PING', '30'))
+    PREWARM_SESSIONS = getenv('PREWARM_SESSIONS', '').strip().lower()
+    GETFILE_CONCURRENCY = int(getenv('GETFILE_CONCURRENCY', '4'))
+    GETFILE_MAX_CONCURRENCY = int(getenv('GETFILE_MAX_CONCURRENCY', '32'))
+    STREAM_RETRIES = int(getenv('STREAM_RETRIES', '2'))
+    FILE_CACHE_SIZE = int(getenv('FILE_CACHE_SIZE', '10000'))
+    FILE_CACHE_TTL = int(getenv('FILE_CACHE_TTL', '1800'))
+    STREAM_MEMORY_LIMIT = int(getenv('STREAM_MEMORY_LIMIT', '512'))
+    STREAM_CACHE_MAX_AGE = int(getenv('STREAM_CACHE_MAX_AGE', '86400'))
+    THUMB_CACHE_MAX_AGE = int(getenv('THUMB_CACHE_MAX_AGE', '604800'))
+    EGRESS_LIMIT = int(getenv('EGRESS_LIMIT', '0'))
+    INTERACTIVE_STREAMS = int(getenv('INTERACTIVE_STREAMS', '2'))
+    INTERACTIVE_WEIGHT = int(getenv('INTERACTIVE_WEIGHT', '4'))
+    TRUSTED_PROXIES = getenv('TRUSTED_PROXIES', '127.0.0.1,::1')
+    STREAM_LIMIT = int(getenv('STREAM_LIMIT', '200'))
+    STREAM_CLIENT_LIMIT = int(getenv('STREAM_CLIENT_LIMIT', '50'))
+    STREAM_QUEUE = int(getenv('STREAM_QUEUE', '50'))
+    STREAM_QUEUE_TIMEOUT = int(getenv('STREAM_QUEUE_TIMEOUT', '10'))
+    CDN_DOWNLOADS = getenv('CDN_DOWNLOADS', '')
+    SLOW_REQUEST_MS = int(getenv('SLOW_REQUEST_MS', '2000'))
@@ -4,12 +4,13 @@ from bot.config import Telegram
 import re
 import datetime
 from bot import LOGGER
+from bot.helper.metrics import mongo_listener
 
 
 class Database:
     def __init__(self):
         MONGODB_URI = Telegram.DATABASE_URL
-        self.mongo_client = MongoClient(MONGODB_URI)
+        self.mongo_client = MongoClient(MONGODB_URI, event_listeners=[mongo_listener])
         self.db = self.mongo_client["surftg"]
         self.collection = self.db["playlist"]
         self.config = self.db["config"]
@@ -262,6 +263,36 @@ class Database:
             LOGGER.error(f"Error getting last indexed ID: {e}")
             return 1
 
+    async def get_file_meta(self, chat_id, msg_id):
+        """Cached media properties and bot file IDs of an indexed file"""
+        try:
+            document = self.files.find_one(
+                {'chat_id': str(chat_id), 'msg_id': {'$in': [int(msg_id), str(msg_id)]}, 'media': {'$exists': True}},
+                {'media': 1}
+            )
+            return document['media'] if document else None
+        except Exception as e:
+            LOGGER.error(f"Error reading file metadata: {e}")
+            return None
+
+    async def save_file_meta(self, chat_id, msg_id, media):
+        """Store media properties on an indexed file, files that are not indexed are skipped"""
+        try:
+            self.files.update_one(
+                {'chat_id': str(chat_id), 'msg_id': {'$in': [int(msg_id), str(msg_id)]}},
+                {'$set': {'media': media}}
+            )
+        except Exception as e:
+            LOGGER.error(f"Error saving file metadata: {e}")
+
+    async def get_recent_files(self, per_chat=20):
+        """Latest indexed message IDs of every channel"""
+        recent = {}
+        for chat_id in self.files.distinct('chat_id'):
+            mydoc = self.files.find({'chat_id': chat_id}, {'msg_id': 1}).sort('msg_id', DESCENDING).limit(per_chat)
+            recent[chat_id] = [int(x['msg_id']) for x in mydoc]
+        return recent
+
     async def search_tgfiles(self, id, query, page=1, per_page=1000):
         """Enhanced Telegram files search with global results"""
         if not query or query.strip() == '':
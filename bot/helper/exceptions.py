@@ -3,4 +3,9 @@ class InvalidHash(Exception):
 
 
 class FIleNotFound(Exception):
-    message = 'File not found!'
\ No newline at end of file
+    message = 'File not found!'
+
+
+class Overloaded(Exception):
+    message = 'Too many streams, try again shortly!'
+    retry_after = 5
\ No newline at end of file
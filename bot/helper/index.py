@@ -7,7 +7,9 @@ from bot.helper.database import Database
 from bot.telegram import StreamBot, UserBot
 from bot.helper.file_size import get_readable_file_size
 from bot.helper.cache import get_cache, save_cache
+from bot.helper.media import is_media
 from asyncio import gather
+from pyrogram.file_id import FileId
 
 db = Database()
 
@@ -157,3 +159,18 @@ async def posts_file(posts, chat_id):
         ))
 
     return ''.join(formatted_posts)
+
+
+async def get_catalog_dcs(per_chat=20):
+    """DCs holding the most recently indexed files of every channel"""
+    dc_ids = set()
+    for chat_id, msg_ids in (await db.get_recent_files(per_chat)).items():
+        try:
+            messages = await StreamBot.get_messages(int(chat_id), msg_ids)
+        except Exception as e:
+            LOGGER.error(f"Error fetching recent files from {chat_id}: {e}")
+            continue
+        for message in messages:
+            if message and not message.empty and (media := is_media(message)):
+                dc_ids.add(FileId.decode(media.file_id).dc_id)
+    return sorted(dc_ids)
@@ -0,0 +1,64 @@
+from time import perf_counter
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from pymongo import monitoring
+
+from bot.helper.tracing import record
+
+RPC_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+FLOOD_WAIT_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 3600)
+
+BYTES_SERVED = Counter("surf_bytes_served_total", "Response body bytes written to stream clients")
+GETFILE_SECONDS = Histogram("surf_getfile_seconds", "Latency of upload.GetFile calls", ["dc"], buckets=RPC_BUCKETS)
+FLOOD_WAITS = Histogram("surf_flood_wait_seconds", "FloodWaits hit while streaming and their durations", ["client"], buckets=FLOOD_WAIT_BUCKETS)
+CACHE_REQUESTS = Counter("surf_cache_requests_total", "Cache lookups", ["cache", "result"])
+MONGO_SECONDS = Histogram("surf_mongo_seconds", "Latency of MongoDB commands", ["command"], buckets=RPC_BUCKETS)
+HTTP_SECONDS = Histogram("surf_http_request_seconds", "Time to handle an HTTP request, including the whole body for streams", ["route", "method", "status"])
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+class MongoListener(monitoring.CommandListener):
+    """
+    Times every command pymongo sends, by command name, and adds it to the
+    trace of the request that sent it (pymongo calls run on the event loop
+    thread, so the request's context is current).
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        record("mongo", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_SECONDS.labels(event.command_name).observe(event.duration_micros / 1e6)
+        record("mongo", event.duration_micros / 1e6)
+
+
+mongo_listener = MongoListener()
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    started = perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        HTTP_SECONDS.labels(route, request.method, str(status)).observe(perf_counter() - started)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
@@ -0,0 +1,86 @@
+import json
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+from typing import Dict, Optional, Tuple
+
+from aiohttp import web
+
+from bot.config import Telegram
+
+
+class Trace:
+    """Phase timings of one HTTP request. Spans with the same name are summed."""
+    __slots__ = ("started", "spans", "ttfb")
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.spans: Dict[str, Tuple[float, int]] = {}
+        self.ttfb: Optional[float] = None
+
+    def add(self, name: str, duration: float) -> None:
+        total, count = self.spans.get(name, (0.0, 0))
+        self.spans[name] = (total + duration, count + 1)
+
+    def server_timing(self) -> str:
+        entries = [f'{name};dur={total * 1000:.1f}' + (f';desc="{count} calls"' if count > 1 else '') for name, (total, count) in self.spans.items()]
+        entries.append(f"total;dur={(perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def record(name: str, duration: float) -> None:
+    if (trace := current_trace.get()) is not None:
+        trace.add(name, duration)
+
+
+@contextmanager
+def span(name: str):
+    """Time the enclosed block into the current request's trace, if there is one."""
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        record(name, perf_counter() - started)
+
+
+def traced(name: str):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@web.middleware
+async def tracing_middleware(request: web.Request, handler):
+    trace = Trace()
+    request["trace"] = trace
+    token = current_trace.set(trace)
+    try:
+        return await handler(request)
+    finally:
+        current_trace.reset(token)
+        # Streams run for as long as the viewer watches, judge them by their first byte
+        elapsed = trace.ttfb if trace.ttfb is not None else perf_counter() - trace.started
+        if Telegram.SLOW_REQUEST_MS and elapsed * 1000 >= Telegram.SLOW_REQUEST_MS:
+            logging.warning("Slow request " + json.dumps({
+                "method": request.method,
+                "path": request.path,
+                "remote": request.remote,
+                "ms": round(elapsed * 1000, 1),
+                "spans": {name: {"ms": round(total * 1000, 1), "calls": count} for name, (total, count) in trace.spans.items()},
+            }))
+
+
+async def add_server_timing(request: web.Request, response: web.StreamResponse) -> None:
+    """on_response_prepare hook: report the phases finished before the headers go out."""
+    if (trace := request.get("trace")) is not None:
+        trace.ttfb = perf_counter() - trace.started
+        response.headers["Server-Timing"] = trace.server_timing()
@@ -2,13 +2,20 @@ from aiohttp.web import Application
 from cryptography.fernet import Fernet
 from aiohttp_session import setup
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
+from prometheus_client import REGISTRY
 
+from bot.helper.metrics import metrics_handler, metrics_middleware
+from bot.helper.tracing import add_server_timing, tracing_middleware
+from bot.server.stream_metrics import StreamCollector
 from bot.server.stream_routes import routes
 
 secret_key = Fernet.generate_key()
 
 async def web_server():
-    web_app = Application(client_max_size=30000000)
+    web_app = Application(client_max_size=30000000, middlewares=[metrics_middleware, tracing_middleware])
+    web_app.on_response_prepare.append(add_server_timing)
     setup(web_app, EncryptedCookieStorage(Fernet(secret_key)))
     web_app.add_routes(routes)
+    web_app.router.add_get('/metrics', metrics_handler)
+    REGISTRY.register(StreamCollector())
     return web_app
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from collections import Counter, deque
+from typing import Deque, List, Optional, Tuple
+
+from bot.config import Telegram
+from bot.helper.exceptions import Overloaded
+
+
+class Waiter:
+    __slots__ = ("candidates", "future")
+
+    def __init__(self, candidates: List[int]):
+        self.candidates = candidates
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class Admission:
+    """
+    Caps the streams served at once, in total (STREAM_LIMIT) and per client
+    in multi_clients (STREAM_CLIENT_LIMIT). A stream that does not fit waits
+    in a queue of at most STREAM_QUEUE entries for up to STREAM_QUEUE_TIMEOUT
+    seconds, after which, or when the queue is full, it is turned away with
+    ``Overloaded`` so clients back off instead of every stream slowing down.
+    Resumed playback (a Range that does not start at 0) is queued ahead of
+    new streams. ``0`` disables a limit.
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.per_client: Counter = Counter()
+        # Resumed playback first, then new streams
+        self.queues: Tuple[Deque[Waiter], Deque[Waiter]] = (deque(), deque())
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self.queues)
+
+    def free_client(self, candidates: List[int]) -> Optional[int]:
+        if Telegram.STREAM_LIMIT and self.active >= Telegram.STREAM_LIMIT:
+            return None
+        for index in candidates:
+            if not Telegram.STREAM_CLIENT_LIMIT or self.per_client[index] < Telegram.STREAM_CLIENT_LIMIT:
+                return index
+        return None
+
+    def take(self, index: int) -> int:
+        self.active += 1
+        self.per_client[index] += 1
+        return index
+
+    def try_admit(self, candidates: List[int]) -> Optional[int]:
+        """
+        Admit background work only if a client is free right now and no stream
+        is waiting, otherwise return None. Pair a client with ``release``.
+        """
+        if self.waiting or (index := self.free_client(candidates)) is None:
+            return None
+        return self.take(index)
+
+    async def admit(self, candidates: List[int], resume: bool) -> int:
+        """
+        Wait for room and return the client, out of ``candidates`` in order of
+        preference, that serves the stream. Pair with ``release``.
+        """
+        ahead = self.queues[0] or (not resume and self.queues[1])
+        if not ahead and (index := self.free_client(candidates)) is not None:
+            return self.take(index)
+        if self.waiting >= Telegram.STREAM_QUEUE:
+            raise Overloaded
+        waiter = Waiter(candidates)
+        queue = self.queues[0 if resume else 1]
+        queue.append(waiter)
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future), Telegram.STREAM_QUEUE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted right as the wait ended, give the slot back
+                self.release(waiter.future.result())
+            else:
+                waiter.future.cancel()
+                queue.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                logging.info(f"Turned a stream away after {Telegram.STREAM_QUEUE_TIMEOUT}s in the queue")
+                raise Overloaded from e
+            raise
+
+    def release(self, index: int) -> None:
+        self.active -= 1
+        self.per_client[index] -= 1
+        self.__wake()
+
+    def __wake(self) -> None:
+        for queue in self.queues:
+            for waiter in list(queue):
+                if Telegram.STREAM_LIMIT and self.active >= Telegram.STREAM_LIMIT:
+                    return
+                # A waiter whose clients are all busy does not hold up the ones behind it
+                if (index := self.free_client(waiter.candidates)) is None:
+                    continue
+                queue.remove(waiter)
+                waiter.future.set_result(self.take(index))
+
+
+admission = Admission()
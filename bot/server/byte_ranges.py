@@ -0,0 +1,81 @@
+import re
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+MAX_RANGES = 32
+# str.isdigit() also takes digits like '²' that int() rejects
+DIGITS = re.compile(r"[0-9]+")
+
+Range = Tuple[int, int]
+
+
+def parse_range(header: str, size: int) -> Optional[List[Range]]:
+    """
+    Parse a ``Range`` header (RFC 7233) into inclusive (start, end) pairs.
+
+    Supports ``a-b``, open ``a-`` and suffix ``-n`` specs. Overlapping and
+    adjacent ranges are coalesced and the result is sorted. Returns None when
+    the header is malformed or asks for too many ranges, in which case it is
+    ignored and the whole file is sent, and an empty list when none of the
+    ranges overlap the file (416).
+    """
+    unit, _, range_set = header.partition("=")
+    if unit.strip().lower() != "bytes" or not range_set:
+        return None
+    specs = [spec.strip() for spec in range_set.split(",") if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last) or (first and not DIGITS.fullmatch(first)) or (last and not DIGITS.fullmatch(last)):
+            return None
+        if not first:
+            suffix = int(last)
+            if suffix and size:
+                ranges.append((max(size - suffix, 0), size - 1))
+            continue
+        start, end = int(first), int(last) if last else size - 1
+        if last and end < start:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+
+    ranges.sort()
+    merged: List[Range] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def multipart_heads(ranges: List[Range], size: int, mime_type: str, boundary: str) -> Tuple[List[bytes], bytes]:
+    heads = [
+        f"--{boundary}\r\nContent-Type: {mime_type}\r\nContent-Range: bytes {start}-{end}/{size}\r\n\r\n".encode()
+        for start, end in ranges
+    ]
+    return heads, f"--{boundary}--\r\n".encode()
+
+
+def multipart_length(ranges: List[Range], heads: List[bytes], tail: bytes) -> int:
+    return sum(len(head) + end - start + 1 + 2 for head, (start, end) in zip(heads, ranges)) + len(tail)
+
+
+async def multipart_body(read: Callable[[int, int], AsyncIterator], ranges: List[Range], heads: List[bytes], tail: bytes) -> AsyncIterator:
+    """
+    A ``multipart/byteranges`` body whose parts come straight from ``read``,
+    a ``yield_file`` bound to one file.
+    """
+    for (start, end), head in zip(ranges, heads):
+        yield head
+        part = read(start, end)
+        try:
+            async for chunk in part:
+                yield chunk
+        finally:
+            await part.aclose()
+        yield b"\r\n"
+    yield tail
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from hashlib import sha1, sha256
+from typing import Dict, List
+
+import tgcrypto
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+from pyrogram import Client, raw
+from pyrogram.crypto import rsa
+from pyrogram.raw.core import Bytes
+from pyrogram.session.internals import DataCenter
+
+HASH_PART = 128 * 1024
+
+
+class CdnHashMismatch(Exception):
+    pass
+
+
+def key_fingerprint(n: int, e: int) -> int:
+    """The RSA key fingerprint MTProto uses: low 64 bits of SHA1 over the TL-serialized n and e."""
+    data = Bytes(n.to_bytes((n.bit_length() + 7) // 8, "big")) + Bytes(e.to_bytes((e.bit_length() + 7) // 8, "big"))
+    return int.from_bytes(sha1(data).digest()[-8:], "little", signed=True)
+
+
+class CdnRedirect:
+    """
+    Where Telegram moved one file: the CDN DC, the token to request it with,
+    the AES-256-CTR key and IV its bytes are encrypted with, and the SHA-256
+    of every HASH_PART block collected so far.
+    """
+    __slots__ = ("dc_id", "file_token", "key", "iv", "hashes")
+
+    def __init__(self, redirect: raw.types.upload.FileCdnRedirect):
+        self.dc_id = redirect.dc_id
+        self.file_token = redirect.file_token
+        self.key = redirect.encryption_key
+        self.iv = redirect.encryption_iv
+        self.hashes: Dict[int, raw.types.FileHash] = {}
+        self.add_hashes(redirect.file_hashes)
+
+    def add_hashes(self, hashes: List[raw.types.FileHash]) -> None:
+        for file_hash in hashes:
+            self.hashes[file_hash.offset] = file_hash
+
+    def decrypt(self, data: bytes, offset: int) -> bytes:
+        # The last four bytes of the IV count 16-byte blocks from the start of the file
+        iv = bytearray(self.iv[:-4] + (offset // 16).to_bytes(4, "big"))
+        return tgcrypto.ctr256_decrypt(data, self.key, iv, bytes(1))
+
+    def missing_hashes(self, offset: int, length: int) -> List[int]:
+        return [block for block in range(offset, offset + length, HASH_PART) if block not in self.hashes]
+
+    def verify(self, data: bytes, offset: int) -> None:
+        """Check decrypted ``data`` starting at the HASH_PART aligned ``offset``."""
+        for block in range(offset, offset + len(data), HASH_PART):
+            file_hash = self.hashes[block]
+            part = data[block - offset:block - offset + file_hash.limit]
+            if sha256(part).digest() != file_hash.hash:
+                raise CdnHashMismatch(f"Hash mismatch at offset {block} of CDN DC {self.dc_id}")
+
+
+class CdnConfig:
+    """
+    Teaches pyrogram about Telegram's CDN DCs: their addresses from
+    help.GetConfig go into DataCenter, and their RSA keys from
+    help.GetCdnConfig into the key table Auth checks fingerprints against.
+    Loaded once per process, before the first CDN session is created.
+    """
+
+    def __init__(self):
+        self.dc_ids: set = set()
+        self.__loading = asyncio.Lock()
+
+    async def load(self, client: Client) -> None:
+        async with self.__loading:
+            if self.dc_ids:
+                return
+            cdn_config = await client.invoke(raw.functions.help.GetCdnConfig())
+            for cdn_key in cdn_config.public_keys:
+                numbers = load_pem_public_key(cdn_key.public_key.encode()).public_numbers()
+                rsa.server_public_keys[key_fingerprint(numbers.n, numbers.e)] = rsa.PublicKey(numbers.n, numbers.e)
+            config = await client.invoke(raw.functions.help.GetConfig())
+            for option in config.dc_options:
+                if not option.cdn:
+                    continue
+                addresses = DataCenter.PROD_IPV6 if option.ipv6 else DataCenter.PROD
+                addresses[option.id] = option.ip_address
+                self.dc_ids.add(option.id)
+            logging.info(f"Loaded CDN DCs {sorted(self.dc_ids)}")
+
+
+cdn_config = CdnConfig()
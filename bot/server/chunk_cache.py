@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Optional, Set, Tuple
+
+from bot.config import Telegram
+from bot.helper.metrics import cache_lookup
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class CachedChunk:
+    """
+    A span of a cached chunk file. The streaming engine hands it to
+    ``loop.sendfile`` so the bytes go from the page cache to the socket
+    without being copied into Python objects.
+    """
+    __slots__ = ("file", "offset", "count")
+
+    def __init__(self, file, offset: int, count: int):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, span: slice) -> "CachedChunk":
+        start, stop, _ = span.indices(self.count)
+        return CachedChunk(self.file, self.offset + start, max(stop - start, 0))
+
+    async def read(self) -> bytes:
+        return await asyncio.to_thread(os.pread, self.file.fileno(), self.count, self.offset)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class DiskCache:
+    """
+    Bounded directory of cache files, least recently used first out beyond
+    ``max_bytes``. Every entry is one file named
+    ``{media_id}_{number}_{length}{suffix}``. Writes go to a temporary file
+    that is renamed into place, and the expected length is part of the name,
+    so an entry that was cut short by a crash is recognised and dropped when
+    the cache is reloaded. The file mtime is bumped on every hit, which keeps
+    the LRU order across restarts. Files without the cache's suffix are left
+    alone, so the directory may be shared.
+    """
+    suffix = ""
+    label = ""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[Tuple[int, int], int] = OrderedDict()
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            self.load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def path(self, media_id: int, number: int, length: int) -> str:
+        return os.path.join(self.directory, f"{media_id}_{number}_{length}{self.suffix}")
+
+    def load(self) -> None:
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp") and f"{self.suffix}." in entry.name:
+                # Left behind by a write that never finished
+                self.drop(entry.path)
+                continue
+            if not entry.name.endswith(self.suffix):
+                continue
+            try:
+                media_id, number, length = map(int, entry.name[:-len(self.suffix)].split("_"))
+                stat = entry.stat()
+            except (ValueError, OSError):
+                logging.debug(f"Dropping unreadable {self.label} cache entry {entry.name}")
+                self.drop(entry.path)
+                continue
+            if stat.st_size != length:
+                self.drop(entry.path)
+                continue
+            found.append((stat.st_mtime, media_id, number, length))
+        for _, media_id, number, length in sorted(found):
+            self.add(media_id, number, length)
+        self.evict()
+        logging.info(f"{self.label.capitalize()} cache loaded {len(self.entries)} entries ({self.size} bytes)")
+
+    @staticmethod
+    def drop(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def add(self, media_id: int, number: int, length: int) -> None:
+        self.entries[(media_id, number)] = length
+        self.size += length
+
+    def remove(self, media_id: int, number: int) -> Optional[int]:
+        """Forget an entry, the file itself is left to the caller."""
+        if (length := self.entries.pop((media_id, number), None)) is not None:
+            self.size -= length
+        return length
+
+    def evict(self) -> None:
+        while self.size > self.max_bytes and self.entries:
+            media_id, number = next(iter(self.entries))
+            length = self.remove(media_id, number)
+            self.drop(self.path(media_id, number, length))
+
+    def open_file(self, media_id: int, number: int):
+        """Open an entry and mark it as recently used, or None if it is gone."""
+        if (length := self.entries.get((media_id, number))) is None:
+            return None
+        path = self.path(media_id, number, length)
+        try:
+            file = open(path, "rb")
+            os.utime(path)
+        except OSError:
+            self.remove(media_id, number)
+            return None
+        self.entries.move_to_end((media_id, number))
+        return file
+
+    async def save(self, media_id: int, number: int, data: bytes) -> None:
+        """Write an entry in a thread and add it as the most recently used. Raises OSError."""
+        await asyncio.to_thread(self.__write, self.path(media_id, number, len(data)), data)
+        if (media_id, number) not in self.entries:
+            self.add(media_id, number, len(data))
+        self.evict()
+
+    @staticmethod
+    def __write(path: str, data: bytes) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+class ChunkCache(DiskCache):
+    """
+    Bounded on-disk cache of 1 MiB file chunks keyed by (media_id, chunk
+    index), stored as ``{media_id}_{index}_{length}.chunk``.
+    """
+    suffix = ".chunk"
+    label = "chunk"
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.__writes: Set[asyncio.Task] = set()
+        super().__init__(directory, max_bytes)
+
+    def open(self, media_id: int, index: int, start: int, size: int) -> Optional["CachedChunk"]:
+        """
+        Open the cached chunk holding ``size`` bytes from ``start`` within
+        chunk ``index``. The open file keeps the data readable even if the
+        chunk is evicted before it has been sent.
+        """
+        if not self.enabled:
+            return None
+        length = self.entries.get((media_id, index))
+        cache_lookup("chunk", length is not None)
+        if length is None or (file := self.open_file(media_id, index)) is None:
+            return None
+        if start >= length:
+            file.close()
+            return None
+        return CachedChunk(file, start, min(size, length - start))
+
+    def store(self, media_id: int, index: int, data: bytes) -> None:
+        """Schedule a chunk to be written to disk in the background."""
+        if not self.enabled or not data or len(data) > self.max_bytes or (media_id, index) in self.entries:
+            return
+        task = asyncio.create_task(self.__store(media_id, index, data))
+        self.__writes.add(task)
+        task.add_done_callback(self.__writes.discard)
+
+    async def __store(self, media_id: int, index: int, data: bytes) -> None:
+        try:
+            await self.save(media_id, index, data)
+        except OSError as e:
+            logging.error(f"Failed to cache chunk {index} of {media_id}: {e}")
+
+
+chunk_cache = ChunkCache(Telegram.CHUNK_CACHE_DIR, Telegram.CHUNK_CACHE_SIZE * 1024 * 1024)
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from time import monotonic
+from typing import Deque, Hashable, Optional
+
+from bot.config import Telegram
+
+LATENCY_TOLERANCE = 2.0
+BASE_LATENCY_DECAY = 1.01
+DECREASE_FACTOR = 0.5
+
+
+class Flow:
+    """
+    Queueing identity of one user's streams in one traffic class. All
+    playback streams of a user share one Flow and all of their bulk
+    downloads another, so limiters queue per user rather than per socket.
+    """
+    __slots__ = ("key", "bulk")
+
+    def __init__(self, key: Hashable, bulk: bool):
+        self.key = key
+        self.bulk = bulk
+
+
+class AIMDLimiter:
+    """
+    Additive-increase/multiplicative-decrease limit on the GetFile calls one
+    client has in flight to one DC.
+
+    The limit starts at GETFILE_CONCURRENCY and grows by roughly one per
+    round of successful calls while their latency stays within
+    LATENCY_TOLERANCE of the best latency seen recently. A FloodWait or a
+    timeout halves it, at most once per base latency so a burst of failures
+    from the same window counts as one congestion event. Calls over the limit
+    queue per stream (or per user ``Flow``) and are admitted round-robin, so a
+    stream with a deep read-ahead window cannot starve the others. Bulk flows
+    have their own round-robin that gets one slot for every
+    INTERACTIVE_WEIGHT handed to playback.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.max_limit = max(1, Telegram.GETFILE_MAX_CONCURRENCY)
+        self.limit = float(min(max(1, Telegram.GETFILE_CONCURRENCY), self.max_limit))
+        self.in_flight = 0
+        self.base_latency: Optional[float] = None
+        self.last_decrease = 0.0
+        self.queues: OrderedDict[Hashable, Deque[asyncio.Future]] = OrderedDict()
+        self.bulk_queues: OrderedDict[Hashable, Deque[asyncio.Future]] = OrderedDict()
+        self.grants = 0
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queues in (self.queues, self.bulk_queues) for queue in queues.values())
+
+    async def acquire(self, stream: Hashable = None) -> None:
+        if not self.queues and not self.bulk_queues and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return
+        queues = self.bulk_queues if isinstance(stream, Flow) and stream.bulk else self.queues
+        future = asyncio.get_running_loop().create_future()
+        queues.setdefault(stream, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted right before the cancellation, hand it on
+                self.release()
+            elif (queue := queues.get(stream)) is not None and future in queue:
+                # __wake may already have popped it while skipping cancelled futures
+                queue.remove(future)
+                if not queue:
+                    del queues[stream]
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self.__wake()
+
+    def __next_queues(self) -> OrderedDict:
+        if not self.queues or (self.bulk_queues and self.grants % (Telegram.INTERACTIVE_WEIGHT + 1) == Telegram.INTERACTIVE_WEIGHT):
+            return self.bulk_queues
+        return self.queues
+
+    def __wake(self) -> None:
+        while (self.queues or self.bulk_queues) and self.in_flight < int(self.limit):
+            queues = self.__next_queues()
+            stream, queue = queues.popitem(last=False)
+            future = queue.popleft()
+            if queue:
+                queues[stream] = queue
+            if not future.done():
+                self.in_flight += 1
+                self.grants += 1
+                future.set_result(None)
+
+    def record(self, latency: float) -> None:
+        """A call finished normally after ``latency`` seconds."""
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        else:
+            # Let the baseline creep up so a permanently slower path is accepted eventually
+            self.base_latency *= BASE_LATENCY_DECAY
+        if latency <= self.base_latency * LATENCY_TOLERANCE:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self.__wake()
+
+    def backoff(self) -> None:
+        """A call hit a FloodWait or timed out."""
+        now = monotonic()
+        if now - self.last_decrease < (self.base_latency or 1):
+            return
+        self.last_decrease = now
+        self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+        logging.info(f"GetFile concurrency for {self.name} cut to {int(self.limit)}")
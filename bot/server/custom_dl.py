@@ -1,105 +1,432 @@
 import asyncio
 import logging
+from collections import OrderedDict, deque
+from time import monotonic
 from pyrogram import utils, raw
-from pyrogram.errors import AuthBytesInvalid
+from pyrogram.errors import AuthBytesInvalid, BadRequest, FileReferenceExpired, FileReferenceInvalid, FloodWait, InternalServerError
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
 from pyrogram.session import Session, Auth
-from typing import Dict, Union
+from typing import Dict, Hashable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from bot.config import Telegram
 from bot.helper.exceptions import FIleNotFound
-from bot.server.file_properties import get_file_ids
-from bot.telegram import work_loads
+from bot.helper.metrics import FLOOD_WAITS, GETFILE_SECONDS
+from bot.helper.tracing import traced
+from bot.server.cdn import HASH_PART, CdnHashMismatch, CdnRedirect, cdn_config
+from bot.server.chunk_cache import CHUNK_SIZE, CachedChunk, chunk_cache
+from bot.server.concurrency import Flow
+from bot.server.file_cache import file_cache
+from bot.server.scheduler import scheduler
+from bot.server.session_pool import MediaSessionPool
+from bot.server.stream_engine import memory_budget
+from bot.telegram import multi_clients, work_loads
 from pyrogram import Client, utils, raw
 
+MIN_REQUEST_SIZE = 4 * 1024
+FIRST_REQUEST_SIZE = 128 * 1024
+MAX_RETRY_WAIT = 5
+RETRY_DELAY = 0.5
+MAX_REUPLOADS = 3
+STREAM_ERRORS = (TimeoutError, OSError, FloodWait, InternalServerError, AuthBytesInvalid)
+FILE_REFERENCE_ERRORS = (FileReferenceExpired, FileReferenceInvalid)
+
+
+def plan_requests(from_bytes: int, until_bytes: int, first_limit: int) -> Iterator[Tuple[int, int]]:
+    """
+    Split a byte range into upload.GetFile (offset, limit) pairs. Telegram wants
+    offsets and limits in multiples of 4 KiB, limits that divide 1 MiB and no
+    request crossing a 1 MiB boundary, so every limit is a power of two that
+    also divides its offset. The first request is only as large as the range
+    needs (at most ``first_limit``) and each following one doubles, which keeps
+    probes cheap and lets sustained reads reach full-size requests.
+    """
+    offset = from_bytes - from_bytes % MIN_REQUEST_SIZE
+    limit = first_limit
+    while offset <= until_bytes:
+        needed = until_bytes - offset + 1
+        size = MIN_REQUEST_SIZE
+        while size < needed and size < min(limit, CHUNK_SIZE):
+            size *= 2
+        while offset % size:
+            size //= 2
+        yield offset, size
+        offset += size
+        limit = size * 2
+
+
+class Reader(NamedTuple):
+    streamer: "ByteStreamer"
+    index: int
+    media_pool: MediaSessionPool
+    location: object
+    file_id: FileId
+
 
 class ByteStreamer:
-    def __init__(self, client: Client):
-        self.clean_timer = 30 * 60
+    # Shared by every client: (media_id, offset, limit) -> [fetch task, waiters]
+    __inflight: Dict[Tuple[int, int, int], list] = {}
+
+    def __init__(self, client: Client, index: int = 0):
         self.client: Client = client
-        self.__cached_file_ids: Dict[int, FileId] = {}
-        asyncio.create_task(self.clean_cache())
+        self.index = index
+        self.__read_positions: OrderedDict[int, Tuple[int, int]] = OrderedDict()
+        self.__media_pools: Dict[int, MediaSessionPool] = {}
+        self.__cdn_pools: Dict[int, MediaSessionPool] = {}
+        self.__cdn_redirects: OrderedDict[int, Optional[CdnRedirect]] = OrderedDict()
+
+    @property
+    def media_pools(self) -> Dict[int, MediaSessionPool]:
+        return self.__media_pools
 
     async def get_file_properties(self, chat_id: int, message_id: int) -> FileId:
-        if message_id not in self.__cached_file_ids:
-            file_id = await get_file_ids(self.client, int(chat_id), int(message_id))
-            if not file_id:
-                logging.info('Message with ID %s not found!', message_id)
-                raise FIleNotFound
-            self.__cached_file_ids[message_id] = file_id
-        return self.__cached_file_ids[message_id]
-
-    async def yield_file(self, file_id: FileId, index: int, offset: int, first_part_cut: int, last_part_cut: int, part_count: int, chunk_size: int) -> Union[str, None]: # type: ignore
-        client = self.client
-        work_loads[index] += 1
-        logging.debug(f"Starting to yielding file with client {index}.")
-        media_session = await self.generate_media_session(client, file_id)
-        current_part = 1
-        location = await self.get_location(file_id)
+        file_id = await file_cache.get_file_id(self.client, int(chat_id), int(message_id))
+        if not file_id:
+            logging.info('Message with ID %s not found!', message_id)
+            raise FIleNotFound
+        return file_id
+
+    def resume_state(self, media_id: int, offset: int, max_depth: int) -> Tuple[int, int]:
+        """
+        Pick the starting read-ahead window and request size for a stream. A
+        request that picks up where the previous one for the same file stopped
+        is treated as sequential playback and keeps its window with full-size
+        requests, anything else is a seek or a probe and starts small.
+        """
+        last_offset, last_depth = self.__read_positions.pop(media_id, (None, 1))
+        if last_offset is not None and last_offset <= offset < last_offset + CHUNK_SIZE:
+            return min(last_depth, max_depth), CHUNK_SIZE
+        return 1, FIRST_REQUEST_SIZE
+
+    def save_position(self, media_id: int, offset: int, depth: int) -> None:
+        self.__read_positions[media_id] = (offset, depth)
+        while len(self.__read_positions) > 1000:
+            self.__read_positions.popitem(last=False)
+
+    @staticmethod
+    async def open_reader(streamer: "ByteStreamer", index: int, file_id: FileId) -> Reader:
+        media_pool = streamer.get_media_pool(file_id.dc_id)
+        await media_pool.warm()
+        return Reader(streamer, index, media_pool, await streamer.get_location(file_id), file_id)
+
+    async def yield_file(self, file_id: FileId, index: int, from_bytes: int, until_bytes: int, stripes: Optional[List[Tuple["ByteStreamer", int, FileId]]] = None, flow: Optional[Flow] = None) -> Union[str, None]: # type: ignore
+        """
+        Stream bytes ``from_bytes`` to ``until_bytes`` (inclusive) of a file.
+        ``stripes`` lists extra (streamer, client index, file_id) triples;
+        requests are then handed out round-robin over this client and the
+        stripes and reassembled in order. A request that fails is retried and
+        then moved to another client, see ``recover``; when no client can
+        serve it the error is raised. GetFile calls queue under ``flow`` when
+        given, otherwise under this stream alone.
+        """
+        sources = [(self, index, file_id)] + (stripes or [])
+        for _, client_index, _ in sources:
+            work_loads[client_index] += 1
+        logging.debug(f"Starting to yielding file with clients {[i for _, i, _ in sources]}.")
+        max_depth = Telegram.PREFETCH_DEPTH * len(sources)
+        depth, first_limit = self.resume_state(file_id.media_id, from_bytes, max_depth)
+        parts = list(plan_requests(from_bytes, until_bytes, first_limit))
+        current_part = 0
+        offset = parts[0][0] if parts else from_bytes
+        pending = deque()
+        stream = flow or object()
+        readers: List[Reader] = []
+        reserved = 0
+        tried = {client_index for _, client_index, _ in sources}
+
+        async def fetch(part: int) -> Union[bytes, CachedChunk, None]:
+            return await self.read(readers, part % len(readers), parts[part], stream)
+
         try:
-            r = await media_session.send(raw.functions.upload.GetFile(location=location, offset=offset, limit=chunk_size))
-            if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
-
-                    current_part += 1
-                    offset += chunk_size
-
-                    if current_part > part_count:
-                        break
-
-                    r = await media_session.send(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
-                    )
-        except (TimeoutError, AttributeError):
-            pass
+            for streamer, client_index, source_file_id in sources:
+                readers.append(await self.open_reader(streamer, client_index, source_file_id))
+
+            while current_part < len(parts):
+                while len(pending) < depth and current_part + len(pending) < len(parts):
+                    size = parts[current_part + len(pending)][1]
+                    # Past the memory budget only a stream with nothing in flight may wait for room
+                    if not memory_budget.try_acquire(size):
+                        if pending:
+                            break
+                        await memory_budget.acquire(size)
+                    reserved += size
+                    pending.append(asyncio.create_task(fetch(current_part + len(pending))))
+
+                try:
+                    chunk = await pending.popleft()
+                except (*STREAM_ERRORS, *FILE_REFERENCE_ERRORS) as e:
+                    chunk = await self.recover(readers, current_part, parts[current_part], stream, e, tried)
+                if not chunk:
+                    break
+                start = max(from_bytes - offset, 0)
+                end = min(until_bytes - offset + 1, len(chunk))
+                if start == 0 and end == len(chunk):
+                    yield chunk
+                else:
+                    yield (chunk if isinstance(chunk, CachedChunk) else memoryview(chunk))[start:end]
+
+                memory_budget.release(parts[current_part][1])
+                reserved -= parts[current_part][1]
+                offset += parts[current_part][1]
+                current_part += 1
+                # Every request consumed in order widens the window until the configured depth
+                depth = min(depth * 2, max_depth)
+        except (TimeoutError, AttributeError, FIleNotFound, *STREAM_ERRORS, *FILE_REFERENCE_ERRORS) as e:
+            logging.error(f"Stream of {file_id.media_id} stopped at offset {offset}: {e!r}")
+            # The response has promised more bytes, ending quietly would leave the client waiting for them
+            raise
         finally:
-            logging.debug("Finished yielding file with {current_part} parts.")
-            work_loads[index] -= 1
-
-    async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(client,
-                                        file_id.dc_id,
-                                        await Auth(client, file_id.dc_id, await client.storage.test_mode()).create(),
-                                        await client.storage.test_mode(),
-                                        is_media=True)
-                await media_session.start()
-                for _ in range(6):
-                    exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id))
-                    try:
-                        await media_session.send(raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes))
-                        break
-                    except AuthBytesInvalid:
-                        logging.debug(
-                            'Invalid authorization bytes for DC %s!', file_id.dc_id)
-                        continue
+            for task in pending:
+                task.cancel()
+            memory_budget.release(reserved)
+            self.save_position(file_id.media_id, offset, depth)
+            logging.debug(f"Finished yielding file with {current_part} requests.")
+            # recover() may have moved a slot to another client, count what is serving now
+            for client_index in [reader.index for reader in readers] + [i for _, i, _ in sources[len(readers):]]:
+                work_loads[client_index] -= 1
+
+    async def read_bytes(self, file_id: FileId, index: int, start: int, length: int, flow: Optional[Flow] = None) -> bytes:
+        """
+        Read a small span of a file into memory, one request at a time. The
+        requests go straight to ``get_chunk``, without read-ahead, failover or
+        a saved read position, so background reads of the header cache and
+        HLS indexes do not change how a viewer's next request is treated.
+        """
+        readers = [await self.open_reader(self, index, file_id)]
+        stream = flow or object()
+        parts = list(plan_requests(start, start + length - 1, CHUNK_SIZE))
+        data = bytearray()
+        for request in parts:
+            chunk = await self.read(readers, 0, request, stream)
+            if not chunk:
+                break
+            if isinstance(chunk, CachedChunk):
+                cached = chunk
+                try:
+                    chunk = await cached.read()
+                finally:
+                    cached.close()
+            data += chunk
+        skip = start - parts[0][0] if parts else 0
+        if len(data) < skip + length:
+            raise EOFError(f"Read {max(len(data) - skip, 0)} of {length} bytes at {start}")
+        return bytes(data[skip:skip + length])
+
+    async def read(self, readers: List[Reader], slot: int, request: Tuple[int, int], stream: Hashable) -> Union[bytes, CachedChunk, None]:
+        """Fetch ``request`` with the reader in ``slot``, refreshing its file_reference once if it expired."""
+        reader = readers[slot]
+        try:
+            return await reader.streamer.get_chunk(reader.media_pool, reader.location, reader.file_id, *request, stream)
+        except FILE_REFERENCE_ERRORS:
+            reader = await self.refresh_reader(readers, slot, reader)
+            return await reader.streamer.get_chunk(reader.media_pool, reader.location, reader.file_id, *request, stream)
+
+    async def refresh_reader(self, readers: List[Reader], slot: int, reader: Reader) -> Reader:
+        """
+        Swap the expired file_reference of a reader for a fresh one and put the
+        new reader in its slot, unless another request already did.
+        """
+        file_id = await reader.streamer.refresh_file_id(reader.file_id)
+        refreshed = reader._replace(file_id=file_id, location=await reader.streamer.get_location(file_id))
+        if readers[slot] is reader:
+            readers[slot] = refreshed
+        return refreshed
+
+    async def refresh_file_id(self, file_id: FileId) -> FileId:
+        return await file_cache.refresh(self.client, file_id)
+
+    async def recover(self, readers: List[Reader], part: int, request: Tuple[int, int], stream: Hashable, error: Exception, tried: set) -> Union[bytes, CachedChunk, None]:
+        """
+        Re-fetch a request that failed mid-stream. It is retried STREAM_RETRIES
+        times on the same client (waiting out short FloodWaits), then resumed
+        on the best remaining client from multi_clients, which also takes over
+        that client's share of the rest of the stream.
+        """
+        slot = part % len(readers)
+        for attempt in range(Telegram.STREAM_RETRIES):
+            if isinstance(error, FloodWait):
+                if error.value > MAX_RETRY_WAIT:
+                    break
+                await asyncio.sleep(error.value)
+            else:
+                await asyncio.sleep(RETRY_DELAY * (attempt + 1))
+            reader = readers[slot]
+            logging.warning(f"Retrying offset {request[0]} of {reader.file_id.media_id} on client {reader.index} after {error!r}")
+            try:
+                return await self.read(readers, slot, request, stream)
+            except (*STREAM_ERRORS, *FILE_REFERENCE_ERRORS) as e:
+                error = e
+
+        failed = readers[slot]
+        chat_id, message_id = failed.file_id.message_chat_id, failed.file_id.message_id
+        for index in scheduler.rank(chat_id, message_id):
+            if index in tried:
+                continue
+            tried.add(index)
+            try:
+                streamer = get_streamer(index)
+                candidate = [await self.open_reader(streamer, index, await streamer.get_file_properties(chat_id, message_id))]
+                chunk = await self.read(candidate, 0, request, stream)
+                reader = candidate[0]
+            except (FIleNotFound, *STREAM_ERRORS, *FILE_REFERENCE_ERRORS) as e:
+                logging.debug(f"Client {index} can not take over {message_id}: {e!r}")
+                continue
+            logging.warning(f"Moved stream of {failed.file_id.media_id} from client {failed.index} to client {index} at offset {request[0]}")
+            if readers[slot] is failed:
+                readers[slot] = reader
+                work_loads[failed.index] -= 1
+                work_loads[index] += 1
+            return chunk
+        raise error
+
+    async def get_chunk(self, media_pool: MediaSessionPool, location, file_id: FileId, offset: int, chunk_size: int, stream: Hashable = None) -> Union[bytes, CachedChunk, None]:
+        """
+        Fetch one chunk. Chunks in the on-disk cache come back as an open
+        CachedChunk, smaller requests are served from the cached 1 MiB chunk
+        that holds them. Otherwise a single upstream request is shared between
+        every stream that asks for the same (media_id, offset, limit) at the
+        same time; the entry is dropped as soon as the last waiter has taken
+        its result.
+        """
+        index, start = divmod(offset, CHUNK_SIZE)
+        if cached := chunk_cache.open(file_id.media_id, index, start, chunk_size):
+            return cached
+        key = (file_id.media_id, offset, chunk_size)
+        if (entry := self.__inflight.get(key)) is None:
+            task = asyncio.create_task(self.fetch_chunk(media_pool, location, file_id, offset, chunk_size, stream))
+            entry = self.__inflight[key] = [task, 0]
+        else:
+            logging.debug(f"Joining in-flight request for chunk {offset} of {file_id.media_id}")
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self.__inflight.get(key) is entry:
+                del self.__inflight[key]
+                entry[0].cancel()
+
+    async def fetch_chunk(self, media_pool: MediaSessionPool, location, file_id: FileId, offset: int, chunk_size: int, stream: Hashable = None) -> Optional[bytes]:
+        """
+        Fetch one chunk from Telegram, or from the CDN DC the file was moved
+        to. Only whole 1 MiB chunks and the tail of the file are written to
+        the chunk cache.
+        """
+        media_id = file_id.media_id
+        started = monotonic()
+        try:
+            if (redirect := self.__cdn_redirects.get(media_id)) is None:
+                cdn_supported = bool(Telegram.CDN_DOWNLOADS) and media_id not in self.__cdn_redirects
+                r = await media_pool.send(raw.functions.upload.GetFile(location=location, offset=offset, limit=chunk_size, cdn_supported=cdn_supported), stream)
+                if isinstance(r, raw.types.upload.FileCdnRedirect):
+                    logging.debug(f"File {media_id} is served by CDN DC {r.dc_id}")
+                    redirect = self.save_redirect(media_id, CdnRedirect(r))
+                elif isinstance(r, raw.types.upload.File):
+                    data = r.bytes
                 else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
+                    return None
+            if redirect is not None:
+                try:
+                    data = await self.fetch_cdn_chunk(media_pool, redirect, offset, chunk_size, stream)
+                except (CdnHashMismatch, BadRequest) as e:
+                    # Fall back to the file's own DC for the rest of this file
+                    logging.warning(f"CDN download of {media_id} failed, using DC {file_id.dc_id}: {e}")
+                    self.save_redirect(media_id, None)
+                    return await self.fetch_chunk(media_pool, location, file_id, offset, chunk_size, stream)
+        except FloodWait as e:
+            scheduler.penalize(self.index, e.value)
+            FLOOD_WAITS.labels(str(self.index)).observe(e.value)
+            raise
+        elapsed = monotonic() - started
+        scheduler.record(self.index, file_id.dc_id, len(data), elapsed)
+        GETFILE_SECONDS.labels(str(file_id.dc_id)).observe(elapsed)
+        if chunk_size == CHUNK_SIZE and (len(data) == chunk_size or offset + len(data) >= file_id.file_size):
+            chunk_cache.store(media_id, offset // CHUNK_SIZE, data)
+        return data
+
+    def save_redirect(self, media_id: int, redirect: Optional[CdnRedirect]) -> Optional[CdnRedirect]:
+        """Remember where a file is served from; ``None`` pins it to its own DC."""
+        self.__cdn_redirects[media_id] = redirect
+        self.__cdn_redirects.move_to_end(media_id)
+        while len(self.__cdn_redirects) > 1000:
+            self.__cdn_redirects.popitem(last=False)
+        return redirect
+
+    async def fetch_cdn_chunk(self, media_pool: MediaSessionPool, redirect: CdnRedirect, offset: int, chunk_size: int, stream: Hashable = None) -> bytes:
+        """
+        Fetch one chunk from a CDN DC. Whole HASH_PART blocks are requested so
+        every block can be checked against its SHA-256 after decryption;
+        hashes and reuploads are requested from the file's own DC.
+        """
+        block_offset = offset - offset % HASH_PART
+        cdn_pool = self.get_cdn_pool(redirect.dc_id)
+        for _ in range(MAX_REUPLOADS):
+            r = await cdn_pool.send(raw.functions.upload.GetCdnFile(file_token=redirect.file_token, offset=block_offset, limit=max(chunk_size, HASH_PART)), stream)
+            if not isinstance(r, raw.types.upload.CdnFileReuploadNeeded):
+                break
+            logging.debug(f"Asking for a reupload of CDN file at offset {block_offset}")
+            redirect.add_hashes(await media_pool.send(raw.functions.upload.ReuploadCdnFile(file_token=redirect.file_token, request_token=r.request_token), stream))
+        else:
+            raise CdnHashMismatch(f"CDN DC {redirect.dc_id} still wants a reupload after {MAX_REUPLOADS} tries")
+
+        data = redirect.decrypt(r.bytes, block_offset)
+        while missing := redirect.missing_hashes(block_offset, len(data)):
+            redirect.add_hashes(await media_pool.send(raw.functions.upload.GetCdnFileHashes(file_token=redirect.file_token, offset=missing[0]), stream))
+            if missing[0] not in redirect.hashes:
+                raise CdnHashMismatch(f"No hash for offset {missing[0]} from DC {media_pool.dc_id}")
+        redirect.verify(data, block_offset)
+        return data[offset - block_offset:offset - block_offset + chunk_size]
+
+    def get_media_pool(self, dc_id: int) -> MediaSessionPool:
+        if (media_pool := self.__media_pools.get(dc_id)) is None:
+            logging.debug(f"Creating media session pool for DC {dc_id}")
+            media_pool = self.__media_pools[dc_id] = MediaSessionPool(self.generate_media_session, dc_id)
+        return media_pool
+
+    def get_cdn_pool(self, dc_id: int) -> MediaSessionPool:
+        if (cdn_pool := self.__cdn_pools.get(dc_id)) is None:
+            logging.debug(f"Creating CDN session pool for DC {dc_id}")
+            cdn_pool = self.__cdn_pools[dc_id] = MediaSessionPool(self.generate_cdn_session, dc_id)
+        return cdn_pool
+
+    async def generate_cdn_session(self, dc_id: int) -> Session:
+        """CDN DCs take an unauthorized key and no ImportAuthorization."""
+        client = self.client
+        await cdn_config.load(client)
+        test_mode = await client.storage.test_mode()
+        cdn_session = Session(client, dc_id, await Auth(client, dc_id, test_mode).create(), test_mode, is_media=True, is_cdn=True)
+        await cdn_session.start()
+        logging.debug(f"Created CDN session for DC {dc_id}")
+        return cdn_session
+
+    @traced("media_session")
+    async def generate_media_session(self, dc_id: int) -> Session:
+        client = self.client
+        if dc_id != await client.storage.dc_id():
+            media_session = Session(client,
+                                    dc_id,
+                                    await Auth(client, dc_id, await client.storage.test_mode()).create(),
+                                    await client.storage.test_mode(),
+                                    is_media=True)
+            await media_session.start()
+            for _ in range(6):
+                exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                try:
+                    await media_session.send(raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes))
+                    break
+                except AuthBytesInvalid:
+                    logging.debug(
+                        'Invalid authorization bytes for DC %s!', dc_id)
+                    continue
             else:
-                media_session = Session(client,
-                                        file_id.dc_id,
-                                        await client.storage.auth_key(),
-                                        await client.storage.test_mode(),
-                                        is_media=True)
-                await media_session.start()
-            logging.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
+                await media_session.stop()
+                raise AuthBytesInvalid
         else:
-            logging.debug(f"Using cached media session for DC {file_id.dc_id}")
+            media_session = Session(client,
+                                    dc_id,
+                                    await client.storage.auth_key(),
+                                    await client.storage.test_mode(),
+                                    is_media=True)
+            await media_session.start()
+        logging.debug(f"Created media session for DC {dc_id}")
         return media_session
 
     @staticmethod
@@ -131,11 +458,32 @@ class ByteStreamer:
                                                            thumb_size=file_id.thumbnail_size)
         return location
 
-    async def clean_cache(self) -> None:
-        """
-        function to clean the cache to reduce memory usage
-        """
-        while True:
-            await asyncio.sleep(self.clean_timer)
-            self.__cached_file_ids.clear()
-            logging.debug("Cleaned the cache")
+class_cache: Dict[Client, ByteStreamer] = {}
+
+
+def get_streamer(index: int) -> ByteStreamer:
+    """Return the ByteStreamer of a client in multi_clients, creating it on first use."""
+    client = multi_clients[index]
+    if client in class_cache:
+        logging.debug(f"Using cached ByteStreamer object for client {index}")
+    else:
+        logging.debug(f"Creating new ByteStreamer object for client {index}")
+        class_cache[client] = ByteStreamer(client, index)
+    return class_cache[client]
+
+
+async def prewarm_media_sessions(dc_ids: List[int]) -> None:
+    """
+    Open a media session (and import the authorization for foreign DCs) on
+    every client for each of ``dc_ids``, so the first stream does not pay for
+    it. The pools are kept warm by their monitors afterwards.
+    """
+    async def warm(index: int, dc_id: int) -> None:
+        media_pool = get_streamer(index).get_media_pool(dc_id)
+        media_pool.keep_warm = True
+        try:
+            await media_pool.warm()
+        except Exception as e:
+            logging.error(f"Failed to pre-warm DC {dc_id} on client {index}: {e}")
+
+    await asyncio.gather(*[warm(index, dc_id) for index in list(multi_clients) for dc_id in dc_ids])
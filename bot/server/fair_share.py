@@ -0,0 +1,141 @@
+import asyncio
+import logging
+from time import monotonic
+from typing import Dict, Optional
+
+from bot.config import Telegram
+from bot.server.concurrency import Flow
+
+BURST_SECONDS = 1.0
+PLAYBACK_DESTINATIONS = ("video", "audio")
+TRUSTED_PROXIES = {address.strip() for address in Telegram.TRUSTED_PROXIES.split(",") if address.strip()}
+
+
+def forwarded_address(hop: str) -> str:
+    """The address of a ``Forwarded`` for= or ``X-Forwarded-For`` entry, without its port."""
+    hop = hop.strip().strip('"')
+    if hop.startswith("["):
+        return hop[1:hop.find("]")]
+    return hop.split(":")[0] if hop.count(":") == 1 else hop
+
+
+def user_key(request) -> str:
+    """
+    The IP address a request's user is told apart by. Behind a proxy in
+    TRUSTED_PROXIES it is the nearest hop of the forwarding header that is
+    not a trusted proxy; when there is none the stream gets a key of its own,
+    so the users behind the proxy are never lumped into one.
+    """
+    remote = request.remote
+    if remote not in TRUSTED_PROXIES:
+        return remote
+    hops = [hop.get("for", "") for hop in request.forwarded] or request.headers.get("X-Forwarded-For", "").split(",")
+    for hop in reversed(hops):
+        if (address := forwarded_address(hop)) and address not in TRUSTED_PROXIES:
+            return address
+    return f"{remote}#{id(request)}"
+
+
+class TokenBucket:
+    """
+    Byte budget refilled at ``rate`` bytes/s and holding at most
+    BURST_SECONDS worth of it. A write larger than what is left goes into
+    debt and the writer sleeps it off, so chunks of any size fit.
+    """
+    __slots__ = ("rate", "tokens", "updated")
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate * BURST_SECONDS
+        self.updated = monotonic()
+
+    async def take(self, size: int) -> None:
+        now = monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.rate * BURST_SECONDS)
+        self.updated = now
+        self.tokens -= size
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class UserShare:
+    __slots__ = ("key", "playback", "bulk", "flows", "bucket")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.playback = 0
+        self.bulk = 0
+        self.flows = (Flow(key, False), Flow(key, True))
+        self.bucket: Optional[TokenBucket] = None
+
+    @property
+    def weight(self) -> int:
+        return Telegram.INTERACTIVE_WEIGHT if self.playback else 1
+
+
+class FairShare:
+    """
+    Splits upstream GetFile slots and egress bandwidth between users, told
+    apart by IP address (viewers share the USERNAME login, see ``user_key``),
+    instead of between sockets.
+
+    A user's first INTERACTIVE_STREAMS concurrent streams, and any request a
+    browser makes for a video or audio element, count as playback; the rest
+    are bulk downloads. Every stream carries its user's Flow, which the
+    GetFile limiters queue on, and when EGRESS_LIMIT is set each user gets a
+    token bucket refilled with a weighted share of it, playback users
+    weighing INTERACTIVE_WEIGHT times more than bulk-only ones.
+    """
+
+    def __init__(self):
+        self.users: Dict[str, UserShare] = {}
+        # Reads nobody is waiting on, such as cache fills, queue together as one bulk download
+        self.background = Flow("background", True)
+
+    @staticmethod
+    def is_playback(dest: Optional[str], user: UserShare) -> bool:
+        return dest in PLAYBACK_DESTINATIONS or user.playback < Telegram.INTERACTIVE_STREAMS
+
+    def open(self, key: str, dest: Optional[str]) -> Flow:
+        """Register a new stream of ``key`` and return the Flow it runs under."""
+        if (user := self.users.get(key)) is None:
+            user = self.users[key] = UserShare(key)
+        if self.is_playback(dest, user):
+            user.playback += 1
+            flow = user.flows[0]
+        else:
+            user.bulk += 1
+            flow = user.flows[1]
+            logging.debug(f"Stream of {key} runs as a bulk download")
+        self.rebalance()
+        return flow
+
+    def close(self, flow: Flow) -> None:
+        if (user := self.users.get(flow.key)) is None:
+            return
+        if flow.bulk:
+            user.bulk -= 1
+        else:
+            user.playback -= 1
+        if not user.playback and not user.bulk:
+            del self.users[flow.key]
+        self.rebalance()
+
+    def rebalance(self) -> None:
+        if Telegram.EGRESS_LIMIT <= 0 or not self.users:
+            return
+        total = sum(user.weight for user in self.users.values())
+        for user in self.users.values():
+            rate = Telegram.EGRESS_LIMIT * 1024 * 1024 * user.weight / total
+            if user.bucket is None:
+                user.bucket = TokenBucket(rate)
+            else:
+                user.bucket.rate = rate
+
+    async def throttle(self, flow: Flow, size: int) -> None:
+        """Wait until the user of ``flow`` may send ``size`` more bytes."""
+        if Telegram.EGRESS_LIMIT > 0 and (user := self.users.get(flow.key)) is not None and user.bucket is not None:
+            await user.bucket.take(size)
+
+
+fair_share = FairShare()
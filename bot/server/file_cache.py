@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from random import uniform
+from time import monotonic, time
+from typing import Dict, Optional, Tuple
+
+from pyrogram import Client
+from pyrogram.file_id import FileId
+
+from bot.config import Telegram
+from bot.helper.database import Database
+from bot.helper.metrics import cache_lookup
+from bot.server.file_properties import get_file_ids
+
+db = Database()
+
+
+class FileEntry:
+    """
+    What the streaming path needs to know about one message: the media
+    properties plus the encoded file_id of every bot that has resolved it,
+    keyed by the bot's user ID (access hashes and file references are per bot).
+    """
+    __slots__ = ("file_name", "file_size", "mime_type", "unique_id", "date", "file_ids", "fetched", "expires")
+
+    def __init__(self, file_name: str, file_size: int, mime_type: str, unique_id: str, date: int = 0, file_ids: Optional[Dict[str, str]] = None, fetched: Optional[float] = None):
+        self.file_name = file_name
+        self.file_size = file_size
+        self.mime_type = mime_type
+        self.unique_id = unique_id
+        self.date = date
+        self.file_ids: Dict[str, str] = file_ids or {}
+        # Wall clock time of the Telegram lookup, stored with the entry so a reloaded copy ages from it
+        self.fetched = time() if fetched is None else fetched
+        # Spread expiry so entries cached together are not all refetched together
+        self.expires = monotonic() + self.fetched - time() + Telegram.FILE_CACHE_TTL * uniform(0.9, 1.1)
+
+    @classmethod
+    def from_file_id(cls, file_id: FileId) -> "FileEntry":
+        return cls(file_id.file_name, file_id.file_size, file_id.mime_type, file_id.unique_id, file_id.date)
+
+    def to_dict(self) -> dict:
+        return {
+            "file_name": self.file_name,
+            "file_size": self.file_size,
+            "mime_type": self.mime_type,
+            "unique_id": self.unique_id,
+            "date": self.date,
+            "file_ids": self.file_ids,
+            "fetched": self.fetched,
+        }
+
+    def file_id(self, bot_id: str, chat_id: int, message_id: int) -> Optional[FileId]:
+        if (encoded := self.file_ids.get(bot_id)) is None:
+            return None
+        file_id = FileId.decode(encoded)
+        setattr(file_id, 'file_name', self.file_name)
+        setattr(file_id, 'file_size', self.file_size)
+        setattr(file_id, 'mime_type', self.mime_type)
+        setattr(file_id, 'unique_id', self.unique_id)
+        setattr(file_id, 'date', self.date)
+        setattr(file_id, 'message_chat_id', chat_id)
+        setattr(file_id, 'message_id', message_id)
+        return file_id
+
+
+class FileCache:
+    """
+    Process-wide file metadata cache keyed by (chat_id, message_id), shared by
+    every client. Entries are evicted by LRU beyond FILE_CACHE_SIZE and expire
+    after about FILE_CACHE_TTL seconds. Misses fall back to the ``media`` field
+    of the Mongo ``files`` document before calling Telegram, so a restarted
+    server can answer HEAD and Range requests for indexed files straight away;
+    a stored copy ages from its own Telegram lookup and one older than the TTL
+    is looked up again, so deleted or edited messages are noticed. Concurrent
+    misses for the same bot and message share one lookup.
+    """
+
+    def __init__(self):
+        self.entries: OrderedDict[Tuple[int, int], FileEntry] = OrderedDict()
+        self.__loading: Dict[Tuple[str, int, int], asyncio.Task] = {}
+
+    def get(self, chat_id: int, message_id: int) -> Optional[FileEntry]:
+        key = (chat_id, message_id)
+        if (entry := self.entries.get(key)) is None:
+            return None
+        if entry.expires < monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, chat_id: int, message_id: int, entry: FileEntry) -> None:
+        key = (chat_id, message_id)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > Telegram.FILE_CACHE_SIZE:
+            self.entries.popitem(last=False)
+
+    async def get_file_id(self, client: Client, chat_id: int, message_id: int) -> FileId:
+        bot_id = str(client.me.id)
+        if (entry := self.get(chat_id, message_id)) and (file_id := entry.file_id(bot_id, chat_id, message_id)):
+            cache_lookup("file", True)
+            return file_id
+        cache_lookup("file", False)
+        return await self.__coalesce(client, bot_id, chat_id, message_id, None)
+
+    async def refresh(self, client: Client, stale: FileId) -> FileId:
+        """
+        Replace a FileId whose file_reference expired. Callers that still hold
+        the stale FileId after someone else refreshed it get the new one.
+        """
+        return await self.__coalesce(client, str(client.me.id), stale.message_chat_id, stale.message_id, stale.encode())
+
+    async def __coalesce(self, client: Client, bot_id: str, chat_id: int, message_id: int, stale: Optional[str]) -> FileId:
+        key = (bot_id, chat_id, message_id)
+        if (task := self.__loading.get(key)) is None:
+            task = self.__loading[key] = asyncio.create_task(self.__load(client, bot_id, chat_id, message_id, stale))
+            task.add_done_callback(lambda _: self.__loading.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def __load(self, client: Client, bot_id: str, chat_id: int, message_id: int, stale: Optional[str]) -> FileId:
+        entry = self.get(chat_id, message_id)
+        if entry is None and (media := await db.get_file_meta(chat_id, message_id)):
+            # A copy without a lookup time counts as expired
+            stored = FileEntry(**{"fetched": 0, **media})
+            if stored.expires > monotonic():
+                entry = stored
+                self.put(chat_id, message_id, entry)
+        if entry is not None and entry.file_ids.get(bot_id, stale) != stale:
+            return entry.file_id(bot_id, chat_id, message_id)
+
+        if stale:
+            logging.info(f"Refreshing file reference of message {message_id} for bot {bot_id}")
+        file_id = await get_file_ids(client, chat_id, message_id)
+        if entry is None:
+            entry = FileEntry.from_file_id(file_id)
+            self.put(chat_id, message_id, entry)
+        entry.file_ids[bot_id] = file_id.encode()
+        await db.save_file_meta(chat_id, message_id, entry.to_dict())
+        return file_id
+
+
+file_cache = FileCache()
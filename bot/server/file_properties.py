@@ -17,4 +17,7 @@ async def get_file_ids(client: Client, chat_id: int, message_id: int) -> Optiona
     setattr(file_id, 'file_size', getattr(media, 'file_size', 0))
     setattr(file_id, 'mime_type', getattr(media, 'mime_type', ''))
     setattr(file_id, 'unique_id', file_unique_id)
+    setattr(file_id, 'date', int(message.date.timestamp()) if message.date else 0)
+    setattr(file_id, 'message_chat_id', chat_id)
+    setattr(file_id, 'message_id', message_id)
     return file_id
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import struct
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from pyrogram.file_id import FileId
+
+from bot.config import Telegram
+from bot.helper.metrics import cache_lookup
+from bot.helper.exceptions import FIleNotFound
+from bot.server.admission import admission
+from bot.server.chunk_cache import CHUNK_SIZE, CachedChunk, DiskCache
+from bot.server.concurrency import Flow
+from bot.server.custom_dl import FILE_REFERENCE_ERRORS, STREAM_ERRORS
+from bot.server.fair_share import fair_share
+
+HEAD_SIZE = CHUNK_SIZE
+TAIL_SIZE = CHUNK_SIZE
+MAX_INDEX_SIZE = 8 * 1024 * 1024
+CUES_SIZE = 2 * 1024 * 1024
+REGIONS_SIZE = 10000
+
+EBML_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+SEEK_HEAD_ID = 0x114D9B74
+SEEK_ID = 0x4DBB
+SEEK_ID_ID = 0x53AB
+SEEK_POSITION_ID = 0x53AC
+CUES_ID = b"\x1c\x53\xbb\x6b"
+
+Span = Tuple[int, int]
+
+
+def read_vint(data: bytes, pos: int, keep_marker: bool) -> Tuple[int, int]:
+    """An EBML variable-length integer at ``pos``, and the position after it."""
+    first = data[pos]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError("Invalid EBML length")
+    if pos + length > len(data):
+        raise ValueError("Truncated EBML value")
+    value = first if keep_marker else first & (0xFF >> length)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    return value, pos + length
+
+
+def mp4_index_spans(head: bytes, size: int) -> List[Span]:
+    """
+    Where the ``moov`` of an MP4 lives when it is not inside the head. The
+    top-level box chain is followed through the head; a box that starts past
+    it is taken to be the trailing ``moov`` if the rest of the file is small.
+    """
+    if head[4:8] != b"ftyp":
+        return []
+    offset = 0
+    while offset < size:
+        if offset + 16 > len(head):
+            if offset >= HEAD_SIZE and size - offset <= MAX_INDEX_SIZE:
+                return [(offset, size - offset)]
+            return []
+        box_size, box_type = struct.unpack_from(">I4s", head, offset)
+        if box_size == 1:
+            box_size, = struct.unpack_from(">Q", head, offset + 8)
+        elif box_size == 0:
+            box_size = size - offset
+        if box_size < 8:
+            return []
+        if box_type == b"moov":
+            return [(offset, box_size)] if offset + box_size > len(head) and box_size <= MAX_INDEX_SIZE else []
+        offset += box_size
+    return []
+
+
+def mkv_index_spans(head: bytes, size: int) -> List[Span]:
+    """Where the Cues of a Matroska file live, taken from the SeekHead."""
+    element_id, pos = read_vint(head, 0, True)
+    if element_id != EBML_ID:
+        return []
+    header_size, pos = read_vint(head, pos, False)
+    element_id, pos = read_vint(head, pos + header_size, True)
+    if element_id != SEGMENT_ID:
+        return []
+    _, segment_start = read_vint(head, pos, False)
+    pos = segment_start
+    while pos < len(head):
+        element_id, body = read_vint(head, pos, True)
+        element_size, body = read_vint(head, body, False)
+        if element_id != SEEK_HEAD_ID:
+            pos = body + element_size
+            continue
+        seek_end = min(body + element_size, len(head))
+        while body < seek_end:
+            seek_id, seek_body = read_vint(head, body, True)
+            seek_size, seek_body = read_vint(head, seek_body, False)
+            target, position = None, None
+            child = seek_body
+            while child < seek_body + seek_size:
+                child_id, value = read_vint(head, child, True)
+                child_size, value = read_vint(head, value, False)
+                if child_id == SEEK_ID_ID:
+                    target = bytes(head[value:value + child_size])
+                elif child_id == SEEK_POSITION_ID:
+                    position = int.from_bytes(head[value:value + child_size], "big")
+                child = value + child_size
+            if seek_id == SEEK_ID and target == CUES_ID and position is not None:
+                start = segment_start + position
+                if HEAD_SIZE <= start < size:
+                    return [(start, min(CUES_SIZE, size - start))]
+                return []
+            body = seek_body + seek_size
+        return []
+    return []
+
+
+def index_spans(head: bytes, size: int) -> List[Span]:
+    try:
+        if head[:4] == EBML_ID.to_bytes(4, "big"):
+            return mkv_index_spans(head, size)
+        return mp4_index_spans(head, size)
+    except (IndexError, ValueError, struct.error):
+        return []
+
+
+class HeaderCache(DiskCache):
+    """
+    On-disk cache of the parts of a media file that players probe before
+    playing or seeking: the first and last HEAD_SIZE/TAIL_SIZE bytes, and the
+    MP4 ``moov`` or Matroska Cues when they lie elsewhere (found by parsing
+    the cached head). The first request that reads one of these regions
+    through Telegram fetches the whole region in the background; later ones
+    get it from disk with sendfile and only go to Telegram for the rest.
+
+    Spans are stored like the chunk cache, one file per span named
+    ``{media_id}_{start}_{length}.span``, evicted least recently used first
+    beyond HEADER_CACHE_SIZE. Fills run as background reads: they only start
+    when admission has a free slot and queue for GetFile as a bulk download.
+    """
+    suffix = ".span"
+    label = "header"
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.spans: Dict[int, Dict[int, int]] = {}
+        self.regions: OrderedDict[int, List[Span]] = OrderedDict()
+        self.__fills: Dict[Tuple[int, int], asyncio.Task] = {}
+        super().__init__(directory, max_bytes)
+
+    def add(self, media_id: int, start: int, length: int) -> None:
+        super().add(media_id, start, length)
+        self.spans.setdefault(media_id, {})[start] = length
+
+    def remove(self, media_id: int, start: int) -> Optional[int]:
+        if (length := super().remove(media_id, start)) is None:
+            return None
+        spans = self.spans.get(media_id, {})
+        spans.pop(start, None)
+        if not spans:
+            self.spans.pop(media_id, None)
+        return length
+
+    def find(self, media_id: int, offset: int) -> Optional[Span]:
+        for start, length in self.spans.get(media_id, {}).items():
+            if start <= offset < start + length:
+                return start, length
+        return None
+
+    def next_start(self, media_id: int, offset: int) -> Optional[int]:
+        return min((start for start in self.spans.get(media_id, {}) if start > offset), default=None)
+
+    def open(self, media_id: int, offset: int, until: int) -> Optional[CachedChunk]:
+        """The cached bytes from ``offset`` up to ``until`` (inclusive) or the end of their span."""
+        if (span := self.find(media_id, offset)) is None:
+            return None
+        start, length = span
+        if (file := self.open_file(media_id, start)) is None:
+            return None
+        return CachedChunk(file, offset - start, min(until + 1, start + length) - offset)
+
+    def get_regions(self, media_id: int, size: int) -> List[Span]:
+        if (regions := self.regions.get(media_id)) is None:
+            regions = [(0, min(HEAD_SIZE, size))]
+            if size > HEAD_SIZE:
+                regions.append((max(size - TAIL_SIZE, HEAD_SIZE), size - max(size - TAIL_SIZE, HEAD_SIZE)))
+            if (head := self.spans.get(media_id, {}).get(0)) is not None:
+                try:
+                    with open(self.path(media_id, 0, head), "rb") as f:
+                        regions += index_spans(f.read(), size)
+                except OSError:
+                    pass
+                self.set_regions(media_id, regions)
+        return regions
+
+    def set_regions(self, media_id: int, regions: List[Span]) -> None:
+        self.regions[media_id] = regions
+        self.regions.move_to_end(media_id)
+        while len(self.regions) > REGIONS_SIZE:
+            self.regions.popitem(last=False)
+
+    def want(self, streamer, file_id: FileId, index: int, offset: int) -> None:
+        """Start caching the region around ``offset`` if it is one players probe."""
+        media_id = file_id.media_id
+        for start, length in self.get_regions(media_id, file_id.file_size):
+            if start <= offset < start + length:
+                key = (media_id, start)
+                if key not in self.entries and key not in self.__fills:
+                    task = self.__fills[key] = asyncio.create_task(self.fill(streamer, file_id, index, start, length))
+                    task.add_done_callback(lambda _: self.__fills.pop(key, None))
+                return
+
+    async def fill(self, streamer, file_id: FileId, index: int, start: int, length: int) -> None:
+        media_id = file_id.media_id
+        if admission.try_admit([index]) is None:
+            # Streams come first, a later request will want the region again
+            logging.debug(f"No room to cache bytes {start}-{start + length - 1} of {media_id}")
+            return
+        try:
+            await self.save(media_id, start, await streamer.read_bytes(file_id, index, start, length, fair_share.background))
+        except (EOFError, FIleNotFound, *STREAM_ERRORS, *FILE_REFERENCE_ERRORS) as e:
+            logging.info(f"Could not cache bytes {start}-{start + length - 1} of {media_id}: {e!r}")
+            return
+        finally:
+            admission.release(index)
+        if start == 0:
+            # Parsed again from the cached head on the next lookup
+            self.regions.pop(media_id, None)
+
+    async def yield_file(self, streamer, file_id: FileId, index: int, from_bytes: int, until_bytes: int, stripes=None, flow: Optional[Flow] = None):
+        """
+        ``ByteStreamer.yield_file`` that answers cached spans from disk and
+        reads only the bytes between them from Telegram.
+        """
+        if not self.enabled:
+            async for chunk in streamer.yield_file(file_id, index, from_bytes, until_bytes, stripes, flow):
+                yield chunk
+            return
+        media_id = file_id.media_id
+        offset = from_bytes
+        while offset <= until_bytes:
+            cached = self.open(media_id, offset, until_bytes)
+            cache_lookup("header", cached is not None)
+            if cached is not None:
+                offset += len(cached)
+                yield cached
+                continue
+            self.want(streamer, file_id, index, offset)
+            next_start = self.next_start(media_id, offset)
+            end = until_bytes if next_start is None else min(until_bytes, next_start - 1)
+            body = streamer.yield_file(file_id, index, offset, end, stripes, flow)
+            try:
+                async for chunk in body:
+                    offset += len(chunk)
+                    yield chunk
+            finally:
+                await body.aclose()
+            if offset <= end:
+                # Telegram had no more bytes, stream_response cuts the short response off
+                return
+
+
+header_cache = HeaderCache(Telegram.HEADER_CACHE_DIR, Telegram.HEADER_CACHE_SIZE * 1024 * 1024)
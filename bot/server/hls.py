@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import struct
+from collections import OrderedDict
+from math import ceil
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from pyrogram.file_id import FileId
+
+from bot.server.concurrency import Flow
+from bot.server.custom_dl import FILE_REFERENCE_ERRORS, STREAM_ERRORS
+
+TARGET_SEGMENT = 6.0
+MAX_TOP_LEVEL_BOXES = 64
+MAX_MOOV_SIZE = 16 * 1024 * 1024
+INDEX_CACHE_SIZE = 512
+MP4_MIME_TYPES = ("video/mp4", "audio/mp4")
+
+
+def may_have_index(file_id: FileId) -> bool:
+    """Only MP4 files can carry a sidx, anything else is not worth a probe."""
+    return file_id.mime_type in MP4_MIME_TYPES
+
+
+class Segment(NamedTuple):
+    offset: int
+    length: int
+    duration: float
+
+
+class HLSIndex(NamedTuple):
+    init_length: int
+    segments: List[Segment]
+
+    def render(self, uri: str) -> str:
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:7",
+            f"#EXT-X-TARGETDURATION:{ceil(max(segment.duration for segment in self.segments))}",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+            "#EXT-X-INDEPENDENT-SEGMENTS",
+            f'#EXT-X-MAP:URI="{uri}",BYTERANGE="{self.init_length}@0"',
+        ]
+        for segment in self.segments:
+            lines += [f"#EXTINF:{segment.duration:.3f},", f"#EXT-X-BYTERANGE:{segment.length}@{segment.offset}", uri]
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+
+def box_header(data: bytes, offset: int, file_end: int) -> Tuple[int, str, int]:
+    """Size, type and header length of the box at ``offset`` in ``data``."""
+    size, box_type = struct.unpack_from(">I4s", data, offset)
+    header = 8
+    if size == 1:
+        size, = struct.unpack_from(">Q", data, offset + 8)
+        header = 16
+    elif size == 0:
+        size = file_end
+    return size, box_type.decode("latin-1"), header
+
+
+def iter_boxes(data: bytes, start: int = 0, end: Optional[int] = None):
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type, header = box_header(data, offset, end - offset)
+        if size < header:
+            return
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def find_box(data: bytes, path: List[str], start: int = 0, end: Optional[int] = None) -> Optional[Tuple[int, int]]:
+    for box_type, body, box_end in iter_boxes(data, start, end):
+        if box_type == path[0]:
+            return (body, box_end) if len(path) == 1 else find_box(data, path[1:], body, box_end)
+    return None
+
+
+def parse_sidx(data: bytes, sidx_end: int) -> Optional[Tuple[int, List[Tuple[int, int, int, bool]]]]:
+    """
+    Timescale and (offset, size, duration, starts_with_sap) references of a
+    ``sidx`` body. Hierarchical indexes pointing at further sidx boxes are
+    not supported.
+    """
+    version = data[0]
+    _, timescale = struct.unpack_from(">II", data, 4)
+    if version == 0:
+        _, first_offset = struct.unpack_from(">II", data, 12)
+        pos = 20
+    else:
+        _, first_offset = struct.unpack_from(">QQ", data, 12)
+        pos = 28
+    count, = struct.unpack_from(">H", data, pos + 2)
+    pos += 4
+    offset = sidx_end + first_offset
+    references = []
+    for _ in range(count):
+        size, duration, sap = struct.unpack_from(">III", data, pos)
+        pos += 12
+        if size >> 31:
+            return None
+        references.append((offset, size & 0x7FFFFFFF, duration, bool(sap >> 31)))
+        offset += size & 0x7FFFFFFF
+    return timescale, references
+
+
+def build_segments(timescale: int, references: list) -> List[Segment]:
+    """
+    Merge sidx subsegments into segments of about TARGET_SEGMENT seconds.
+    A new segment only starts on a subsegment that begins with a stream
+    access point, so every segment opens on a keyframe.
+    """
+    segments: List[Segment] = []
+    for offset, size, duration, starts_with_sap in references:
+        seconds = duration / timescale
+        if segments and (not starts_with_sap or segments[-1].duration < TARGET_SEGMENT):
+            last = segments[-1]
+            segments[-1] = Segment(last.offset, last.length + size, last.duration + seconds)
+        else:
+            segments.append(Segment(offset, size, seconds))
+    return segments
+
+
+class HLSIndexer:
+    """
+    Builds HLS playlists for fragmented MP4 files from their ``sidx`` index.
+
+    Only the top-level box headers, the ``moov`` and the ``sidx`` are read, so a
+    file costs a handful of small reads once. The init segment is everything
+    up to the end of ``moov`` and each media segment is a run of moof/mdat
+    pairs starting on a keyframe, all served as byte ranges of the normal
+    stream URL. Results, including files that can not be indexed, are kept
+    per file_unique_id. Files that are not MP4, going by their mime type and
+    a leading ``ftyp`` box, are turned down before anything else is read.
+    """
+
+    def __init__(self):
+        self.indexes: OrderedDict[str, Optional[HLSIndex]] = OrderedDict()
+        self.__building: Dict[str, asyncio.Task] = {}
+        self.__warming: Set[str] = set()
+
+    def peek(self, file_id: FileId) -> Tuple[bool, Optional[HLSIndex]]:
+        """Whether the index of a file is known, and the index if it has one, without reading anything."""
+        key = file_id.unique_id
+        return key in self.indexes, self.indexes.get(key)
+
+    def warm(self, file_id: FileId, load: Callable[[], Awaitable]) -> None:
+        """
+        Run ``load()``, a coroutine ending in ``get``, in the background so a
+        later request finds the index ready. Page views of a file whose
+        warmup is still running do not start another.
+        """
+        key = file_id.unique_id
+        if key in self.indexes or key in self.__warming:
+            return
+        self.__warming.add(key)
+
+        def warmed(task: asyncio.Task) -> None:
+            self.__warming.discard(key)
+            if not task.cancelled() and (e := task.exception()):
+                logging.info(f"Background HLS index build failed: {e!r}")
+
+        asyncio.create_task(load()).add_done_callback(warmed)
+
+    async def get(self, streamer, file_id: FileId, index: int, flow: Optional[Flow] = None) -> Optional[HLSIndex]:
+        key = file_id.unique_id
+        if key in self.indexes:
+            self.indexes.move_to_end(key)
+            return self.indexes[key]
+        if (task := self.__building.get(key)) is None:
+            task = self.__building[key] = asyncio.create_task(self.build(streamer, file_id, index, flow))
+            task.add_done_callback(lambda _: self.__building.pop(key, None))
+        try:
+            hls_index = await asyncio.shield(task)
+        except (EOFError, *STREAM_ERRORS, *FILE_REFERENCE_ERRORS) as e:
+            # The read failed or was cut short, try again on the next request
+            logging.info(f"Can not read the index of {file_id.media_id}: {e!r}")
+            return None
+        self.indexes[key] = hls_index
+        while len(self.indexes) > INDEX_CACHE_SIZE:
+            self.indexes.popitem(last=False)
+        return hls_index
+
+    async def build(self, streamer, file_id: FileId, index: int, flow: Optional[Flow] = None) -> Optional[HLSIndex]:
+        try:
+            return await self.__build(streamer, file_id, index, flow)
+        except (struct.error, ValueError) as e:
+            logging.info(f"Can not build HLS index for {file_id.media_id}: {e!r}")
+            return None
+
+    async def __build(self, streamer, file_id: FileId, index: int, flow: Optional[Flow]) -> Optional[HLSIndex]:
+        size = file_id.file_size
+        if not may_have_index(file_id) or size < 8:
+            return None
+        moov = sidx = None
+        offset = 0
+        for _ in range(MAX_TOP_LEVEL_BOXES):
+            if offset + 8 > size:
+                break
+            header = await streamer.read_bytes(file_id, index, offset, min(16, size - offset), flow)
+            box_size, box_type, header_length = box_header(header, 0, size - offset)
+            if offset == 0 and box_type != "ftyp":
+                # Not ISO BMFF, walking on would chase random "box sizes" through the file
+                return None
+            if box_size < header_length:
+                break
+            if box_type == "moov":
+                moov = (offset, box_size)
+            elif box_type == "sidx":
+                sidx = (offset, box_size)
+            elif box_type in ("moof", "mdat") and moov:
+                # Fragments have started, a global sidx always comes before them
+                break
+            if moov and sidx:
+                break
+            offset += box_size
+
+        if not moov or not sidx or moov[1] > MAX_MOOV_SIZE or sidx[1] > MAX_MOOV_SIZE:
+            return None
+        moov_data = await streamer.read_bytes(file_id, index, *moov, flow)
+        if find_box(moov_data, ["moov", "mvex"]) is None:
+            return None
+        sidx_data = await streamer.read_bytes(file_id, index, *sidx, flow)
+        if (sidx_box := find_box(sidx_data, ["sidx"])) is None:
+            raise ValueError(f"No sidx box at {sidx[0]}")
+        body, _ = sidx_box
+        if (parsed := parse_sidx(sidx_data[body:], sidx[0] + sidx[1])) is None:
+            return None
+        timescale, references = parsed
+        if not timescale or not references:
+            return None
+        return HLSIndex(moov[0] + moov[1], build_segments(timescale, references))
+
+
+hls_indexer = HLSIndexer()
@@ -0,0 +1,60 @@
+from email.utils import formatdate
+from typing import Dict
+
+from aiohttp import web
+
+
+def entity_tag(unique_id: str) -> str:
+    """Strong ETag for a Telegram file. file_unique_id is the same for every copy of the same bytes."""
+    return f'"{unique_id}"'
+
+
+def cache_control(max_age: int) -> str:
+    return f"public, max-age={max_age}" if max_age > 0 else "no-cache"
+
+
+def validator_headers(etag: str, date: int, max_age: int) -> Dict[str, str]:
+    headers = {"ETag": etag, "Cache-Control": cache_control(max_age)}
+    if date:
+        headers["Last-Modified"] = formatdate(date, usegmt=True)
+    return headers
+
+
+def etag_matches(header: str, etag: str, weak: bool) -> bool:
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def not_modified(request: web.Request, etag: str, date: int) -> bool:
+    """
+    Whether a GET or HEAD can be answered with 304. If-Modified-Since is only
+    looked at when there is no If-None-Match, as RFC 7232 requires.
+    """
+    if (if_none_match := request.headers.get("If-None-Match")) is not None:
+        return etag_matches(if_none_match, etag, weak=True)
+    if date and (since := request.if_modified_since) is not None:
+        return date <= since.timestamp()
+    return False
+
+
+def range_applies(request: web.Request, etag: str, date: int) -> bool:
+    """
+    Whether the Range header should be honoured. An If-Range validator that no
+    longer matches means the client's partial copy is stale, so it gets the
+    whole file instead of a piece of a different one.
+    """
+    if (if_range := request.headers.get("If-Range")) is None:
+        return True
+    if if_range.startswith(('"', 'W/"')):
+        return etag_matches(if_range, etag, weak=False)
+    since = request.if_range
+    return bool(date) and since is not None and int(since.timestamp()) == date
@@ -7,7 +7,13 @@ from bot.config import Telegram
 from bot.helper.database import Database
 from bot.helper.exceptions import InvalidHash
 from bot.helper.file_size import get_readable_file_size
+from bot.helper.tracing import traced
+from bot.server.admission import admission
+from bot.server.custom_dl import get_streamer
+from bot.server.fair_share import fair_share
 from bot.server.file_properties import get_file_ids
+from bot.server.hls import hls_indexer, may_have_index
+from bot.server.scheduler import scheduler
 from bot.telegram import StreamBot
 
 db = Database()
@@ -27,6 +33,35 @@ hide_channel = """
                     </style>"""
 
 
+async def load_hls_index(chat_id: int, message_id: int):
+    """Build an HLS index in the background, only when a client is free and as a bulk download."""
+    if (index := admission.try_admit(scheduler.rank(chat_id, message_id))) is None:
+        return None
+    try:
+        streamer = get_streamer(index)
+        file_id = await streamer.get_file_properties(chat_id=chat_id, message_id=message_id)
+        return await hls_indexer.get(streamer, file_id, index, fair_share.background)
+    finally:
+        admission.release(index)
+
+
+def hls_link(file_data, chat_id, id, secure_hash) -> str:
+    """
+    The HLS playlist of a video when its index is already known. An MP4 that
+    has not been looked at yet plays progressively this time while its index
+    is built in the background, so the player never waits for the probe.
+    """
+    if not may_have_index(file_data):
+        return ''
+    known, hls_index = hls_indexer.peek(file_data)
+    if not known:
+        hls_indexer.warm(file_data, lambda: load_hls_index(int(chat_id), int(id)))
+    if hls_index is None:
+        return ''
+    return f"/hls/{str(chat_id).replace('-100', '')}?id={id}&hash={secure_hash}"
+
+
+@traced("render")
 async def render_page(id, secure_hash, is_admin=False, html='', playlist='', database='', route='', redirect_url='', msg='', chat_id=''):
     theme = await db.get_variable('theme')
     if theme is None or theme == '':
@@ -67,7 +102,7 @@ async def render_page(id, secure_hash, is_admin=False, html='', playlist='', dat
         if tag == 'video':
             async with aiopen(ospath.join(tpath, 'video.html')) as r:
                 poster = f"/api/thumb/{chat_id}?id={id}"
-                html = (await r.read()).replace('<!-- Filename -->', filename).replace("<!-- Theme -->", theme.lower()).replace('<!-- Poster -->', poster).replace('<!-- Size -->', size).replace('<!-- Username -->', StreamBot.me.username)
+                html = (await r.read()).replace('<!-- Filename -->', filename).replace("<!-- Theme -->", theme.lower()).replace('<!-- Poster -->', poster).replace('<!-- Size -->', size).replace('<!-- Username -->', StreamBot.me.username).replace('<!-- HLS -->', hls_link(file_data, chat_id, id, secure_hash))
         else:
             async with aiopen(ospath.join(tpath, 'dl.html')) as r:
                 html = (await r.read()).replace('<!-- Filename -->', filename).replace("<!-- Theme -->", theme.lower()).replace('<!-- Size -->', size)
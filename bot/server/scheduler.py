@@ -0,0 +1,89 @@
+import logging
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from bot.telegram import work_loads
+
+ALPHA = 0.2
+DEFAULT_THROUGHPUT = 4 * 1024 * 1024
+COLD_DC_COST = 1.5
+AFFINITY_BONUS = 0.5
+AFFINITY_SIZE = 5000
+
+
+class ClientStats:
+    __slots__ = ("throughput", "latency", "penalty_until")
+
+    def __init__(self):
+        self.throughput: Optional[float] = None
+        self.latency: Dict[int, float] = {}
+        self.penalty_until = 0.0
+
+
+def ewma(current: Optional[float], sample: float) -> float:
+    return sample if current is None else current + ALPHA * (sample - current)
+
+
+class ClientScheduler:
+    """
+    Chooses the client in multi_clients that should serve a file.
+
+    Each client is scored by the time it would take to drain its active
+    streams plus one more at its measured throughput (EWMA of bytes/s over
+    GetFile calls), plus its RPC latency to the file's DC. A DC the client has
+    never talked to costs an extra COLD_DC_COST seconds for the session
+    setup, clients inside a FloodWait penalty window are only used when
+    nothing else is left, and the client that served the same file last gets
+    its score halved so its caches and sessions are reused.
+    """
+
+    def __init__(self):
+        self.stats: Dict[int, ClientStats] = {}
+        self.affinity: OrderedDict[Tuple[int, int], Tuple[int, int]] = OrderedDict()
+
+    def get_stats(self, index: int) -> ClientStats:
+        if (stats := self.stats.get(index)) is None:
+            stats = self.stats[index] = ClientStats()
+        return stats
+
+    def record(self, index: int, dc_id: int, nbytes: int, elapsed: float) -> None:
+        """Feed the outcome of one GetFile call."""
+        stats = self.get_stats(index)
+        stats.latency[dc_id] = ewma(stats.latency.get(dc_id), elapsed)
+        if nbytes and elapsed > 0:
+            stats.throughput = ewma(stats.throughput, nbytes / elapsed)
+
+    def penalize(self, index: int, seconds: float) -> None:
+        stats = self.get_stats(index)
+        stats.penalty_until = max(stats.penalty_until, monotonic() + seconds)
+        logging.info(f"Client {index} is penalized for {seconds}s")
+
+    def score(self, index: int, dc_id: Optional[int], preferred: Optional[int]) -> Tuple[bool, float]:
+        stats = self.get_stats(index)
+        throughput = stats.throughput or max((s.throughput for s in self.stats.values() if s.throughput), default=DEFAULT_THROUGHPUT)
+        cost = (work_loads.get(index, 0) + 1) * 1024 * 1024 / throughput
+        if dc_id is not None:
+            cost += stats.latency.get(dc_id, COLD_DC_COST)
+        if index == preferred:
+            cost *= AFFINITY_BONUS
+        return stats.penalty_until > monotonic(), cost
+
+    def rank(self, chat_id: int, message_id: int) -> List[int]:
+        """Clients ordered from best to worst for a file."""
+        preferred, dc_id = self.affinity.get((chat_id, message_id), (None, None))
+        return sorted(work_loads, key=lambda index: self.score(index, dc_id, preferred))
+
+    def pick(self, chat_id: int, message_id: int) -> int:
+        return self.rank(chat_id, message_id)[0]
+
+    def assign(self, chat_id: int, message_id: int, index: int, dc_id: int) -> None:
+        """Remember which client served a file and the DC it lives on."""
+        key = (chat_id, message_id)
+        self.affinity[key] = (index, dc_id)
+        self.affinity.move_to_end(key)
+        while len(self.affinity) > AFFINITY_SIZE:
+            self.affinity.popitem(last=False)
+
+
+scheduler = ClientScheduler()
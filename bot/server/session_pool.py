@@ -0,0 +1,158 @@
+import asyncio
+import logging
+from random import randint
+from time import monotonic, time
+from typing import Awaitable, Callable, Hashable, List, Optional
+
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+
+from bot.config import Telegram
+from bot.server.concurrency import AIMDLimiter
+
+PING_TIMEOUT = 10
+MAX_FAILURES = 3
+
+
+class PooledSession:
+    __slots__ = ("session", "in_flight", "failures", "last_used")
+
+    def __init__(self, session: Session):
+        self.session = session
+        self.in_flight = 0
+        self.failures = 0
+        self.last_used = time()
+
+
+class MediaSessionPool:
+    """
+    A pool of up to MEDIA_SESSIONS media sessions of one client to one DC.
+
+    Every request goes to the least busy session that is below its in-flight
+    cap; when all of them are busy the pool grows in the background and the
+    request waits for a free slot. Idle sessions are pinged periodically and a
+    session that fails its ping, or keeps failing requests, is replaced.
+    """
+
+    def __init__(self, factory: Callable[[int], Awaitable[Session]], dc_id: int):
+        self.factory = factory
+        self.dc_id = dc_id
+        self.size = max(1, Telegram.MEDIA_SESSIONS)
+        self.max_in_flight = max(1, Telegram.MEDIA_SESSION_REQUESTS)
+        self.sessions: List[PooledSession] = []
+        self.keep_warm = False
+        self.limiter = AIMDLimiter(f"DC {dc_id}")
+        self.__growing: Optional[asyncio.Task] = None
+        self.__available = asyncio.Condition()
+        self.__monitor = asyncio.create_task(self.monitor())
+
+    @property
+    def in_flight(self) -> int:
+        return sum(pooled.in_flight for pooled in self.sessions)
+
+    def grow(self) -> asyncio.Task:
+        if self.__growing is None or self.__growing.done():
+            self.__growing = asyncio.create_task(self.__add_session())
+            self.__growing.add_done_callback(self.__grown)
+        return self.__growing
+
+    async def __add_session(self) -> None:
+        session = await self.factory(self.dc_id)
+        self.sessions.append(PooledSession(session))
+        logging.debug(f"Media session pool for DC {self.dc_id} now has {len(self.sessions)} sessions")
+        async with self.__available:
+            self.__available.notify_all()
+
+    def __grown(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and (e := task.exception()):
+            logging.error(f"Failed to add a media session for DC {self.dc_id}: {e}")
+
+    async def warm(self) -> None:
+        """Make sure the pool holds at least one session."""
+        if not self.sessions:
+            await asyncio.shield(self.grow())
+
+    async def acquire(self) -> PooledSession:
+        while True:
+            if not self.sessions:
+                await self.warm()
+                continue
+            ready = [pooled for pooled in self.sessions if pooled.in_flight < self.max_in_flight]
+            if len(self.sessions) < self.size and (not ready or min(pooled.in_flight for pooled in ready) > 0):
+                self.grow()
+            if ready:
+                pooled = min(ready, key=lambda p: p.in_flight)
+                pooled.in_flight += 1
+                return pooled
+            async with self.__available:
+                await self.__available.wait()
+
+    async def release(self, pooled: PooledSession) -> None:
+        pooled.in_flight -= 1
+        pooled.last_used = time()
+        async with self.__available:
+            self.__available.notify()
+
+    async def send(self, query, stream: Hashable = None):
+        """
+        Send a query on the least busy session once the pool's concurrency
+        limiter admits it. ``stream`` identifies the caller for fair queueing.
+        """
+        await self.limiter.acquire(stream)
+        try:
+            pooled = await self.acquire()
+            started = monotonic()
+            try:
+                result = await pooled.session.send(query)
+            except FloodWait:
+                self.limiter.backoff()
+                raise
+            except (TimeoutError, OSError):
+                self.limiter.backoff()
+                pooled.failures += 1
+                if pooled.failures >= MAX_FAILURES:
+                    self.replace(pooled, "too many failed requests")
+                raise
+            else:
+                self.limiter.record(monotonic() - started)
+                pooled.failures = 0
+                return result
+            finally:
+                await self.release(pooled)
+        finally:
+            self.limiter.release()
+
+    def replace(self, pooled: PooledSession, reason: str) -> None:
+        if pooled not in self.sessions:
+            return
+        logging.warning(f"Replacing media session for DC {self.dc_id}: {reason}")
+        self.sessions.remove(pooled)
+        asyncio.create_task(pooled.session.stop())
+        self.grow()
+
+    async def ping(self, pooled: PooledSession) -> None:
+        try:
+            await asyncio.wait_for(pooled.session.send(raw.functions.Ping(ping_id=randint(0, 2 ** 31 - 1))), PING_TIMEOUT)
+            pooled.failures = 0
+        except Exception as e:
+            self.replace(pooled, f"ping failed ({e!r})")
+
+    async def monitor(self) -> None:
+        """
+        Ping idle sessions every MEDIA_SESSION_PING seconds. Busy sessions are
+        skipped, their own requests already tell whether they are alive. A
+        pre-warmed pool that lost all its sessions is warmed up again.
+        """
+        while True:
+            await asyncio.sleep(Telegram.MEDIA_SESSION_PING)
+            if self.keep_warm and not self.sessions:
+                logging.info(f"Re-warming media session pool for DC {self.dc_id}")
+                self.grow()
+            idle = [pooled for pooled in self.sessions if not pooled.in_flight]
+            await asyncio.gather(*[self.ping(pooled) for pooled in idle])
+
+    async def close(self) -> None:
+        self.__monitor.cancel()
+        sessions, self.sessions = self.sessions, []
+        await asyncio.gather(*[pooled.session.stop() for pooled in sessions], return_exceptions=True)
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from typing import AsyncIterator, List, Optional, Union
+
+from aiohttp import web
+
+from bot.config import Telegram
+from bot.helper.metrics import BYTES_SERVED
+from bot.helper.tracing import span
+from bot.server.chunk_cache import CachedChunk
+from bot.server.concurrency import Flow
+from bot.server.fair_share import fair_share
+
+
+class MemoryBudget:
+    """
+    Upper bound on the chunk bytes that have been requested from Telegram but
+    not yet written to a client, across all streams. A request that does not
+    fit waits until other streams have written their chunks; one request is
+    always let through when nothing is held so a single stream cannot stall.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.__waiters: List[asyncio.Future] = []
+
+    def try_acquire(self, size: int) -> bool:
+        if self.used and self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+
+    async def acquire(self, size: int) -> None:
+        while not self.try_acquire(size):
+            future = asyncio.get_running_loop().create_future()
+            self.__waiters.append(future)
+            try:
+                await future
+            finally:
+                if future in self.__waiters:
+                    self.__waiters.remove(future)
+
+    def release(self, size: int) -> None:
+        if not size:
+            return
+        self.used -= size
+        waiters, self.__waiters = self.__waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+
+async def send_cached(request: web.Request, response: web.StreamResponse, chunk: CachedChunk) -> None:
+    """Send a cached chunk with sendfile, or by reading it when the loop or transport can not."""
+    try:
+        try:
+            await asyncio.get_running_loop().sendfile(request.transport, chunk.file, chunk.offset, chunk.count)
+        except NotImplementedError:
+            await response.write(await chunk.read())
+    finally:
+        chunk.close()
+
+
+async def stream_response(request: web.Request, response: web.StreamResponse, body: AsyncIterator[Union[bytes, memoryview, CachedChunk]], flow: Optional[Flow] = None) -> web.StreamResponse:
+    """
+    Write a streamed body. Every write waits for the transport to drain below
+    its high-water mark, so a slow reader holds back its own stream instead of
+    piling up buffers, and cached chunks go out with sendfile. With a
+    ``flow``, writes also wait for the user's share of EGRESS_LIMIT.
+
+    The first chunk is fetched before the headers are sent, so their
+    Server-Timing covers the first upstream request too, and an error there
+    is raised for the route to answer. Once the headers are out, a body that
+    fails or ends short of its Content-Length closes the connection, so the
+    client sees the cut instead of waiting for bytes that never come.
+    """
+    sent = 0
+
+    async def write(chunk: Union[bytes, memoryview, CachedChunk]) -> None:
+        nonlocal sent
+        if flow is not None:
+            await fair_share.throttle(flow, len(chunk))
+        size = len(chunk)
+        if isinstance(chunk, CachedChunk):
+            await send_cached(request, response, chunk)
+        else:
+            await response.write(chunk)
+        sent += size
+        BYTES_SERVED.inc(size)
+
+    first = None
+    try:
+        if request.method != "HEAD":
+            with span("first_chunk"):
+                first = await anext(body, None)
+        await response.prepare(request)
+        if first is not None:
+            chunk, first = first, None
+            await write(chunk)
+            async for chunk in body:
+                await write(chunk)
+        if request.method != "HEAD":
+            if response.content_length is not None and sent < response.content_length:
+                raise EOFError(f"Sent {sent} of {response.content_length} bytes")
+            await response.write_eof()
+    except ConnectionResetError as e:
+        logging.debug(f"Client {request.remote} went away: {e!r}")
+    except Exception as e:
+        if not response.prepared:
+            raise
+        logging.error(f"Response to {request.remote} cut short: {e!r}")
+        response.force_close()
+        if request.transport is not None:
+            request.transport.close()
+    finally:
+        if isinstance(first, CachedChunk):
+            first.close()
+        await body.aclose()
+    return response
+
+
+memory_budget = MemoryBudget(Telegram.STREAM_MEMORY_LIMIT * 1024 * 1024)
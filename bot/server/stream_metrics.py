@@ -0,0 +1,39 @@
+from prometheus_client.core import GaugeMetricFamily
+
+from bot.server.admission import admission
+from bot.server.chunk_cache import chunk_cache
+from bot.server.custom_dl import class_cache
+from bot.server.file_cache import file_cache
+from bot.server.header_cache import header_cache
+from bot.server.stream_engine import memory_budget
+from bot.telegram import work_loads
+
+
+class StreamCollector:
+    """Reports the live state of the streaming path every time /metrics is scraped."""
+
+    def collect(self):
+        active = GaugeMetricFamily("surf_active_streams", "Streams each client is serving", labels=["client"])
+        for index, load in work_loads.items():
+            active.add_metric([str(index)], load)
+        yield active
+
+        sessions = GaugeMetricFamily("surf_media_sessions", "Open media sessions", labels=["client", "dc"])
+        in_flight = GaugeMetricFamily("surf_media_requests_in_flight", "Requests in flight on media sessions", labels=["client", "dc"])
+        limit = GaugeMetricFamily("surf_getfile_concurrency_limit", "Current AIMD limit on GetFile calls", labels=["client", "dc"])
+        waiting = GaugeMetricFamily("surf_getfile_waiting", "GetFile calls queued behind the limit", labels=["client", "dc"])
+        for streamer in list(class_cache.values()):
+            for dc_id, media_pool in streamer.media_pools.items():
+                labels = [str(streamer.index), str(dc_id)]
+                sessions.add_metric(labels, len(media_pool.sessions))
+                in_flight.add_metric(labels, media_pool.in_flight)
+                limit.add_metric(labels, int(media_pool.limiter.limit))
+                waiting.add_metric(labels, media_pool.limiter.waiting)
+        yield from (sessions, in_flight, limit, waiting)
+
+        yield GaugeMetricFamily("surf_admitted_streams", "Streams holding an admission slot", value=admission.active)
+        yield GaugeMetricFamily("surf_queued_streams", "Streams waiting for an admission slot", value=admission.waiting)
+        yield GaugeMetricFamily("surf_stream_memory_bytes", "Chunk bytes fetched but not yet sent", value=memory_budget.used)
+        yield GaugeMetricFamily("surf_chunk_cache_bytes", "Size of the chunk cache", value=chunk_cache.size)
+        yield GaugeMetricFamily("surf_header_cache_bytes", "Size of the header cache", value=header_cache.size)
+        yield GaugeMetricFamily("surf_file_cache_entries", "Files in the metadata cache", value=len(file_cache.entries))
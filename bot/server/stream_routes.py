@@ -1,20 +1,31 @@
 import json
 import logging
-import math
 import mimetypes
 import secrets
+from urllib.parse import quote
+from asyncio import gather
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
 from bot.helper.chats import get_chats, post_playlist, posts_chat, posts_db_file
 from bot.helper.database import Database
 from bot.helper.search import search
 from bot.helper.thumbnail import get_image
-from bot.telegram import work_loads, multi_clients
+from bot.telegram import multi_clients
 from aiohttp_session import get_session
 from bot.config import Telegram
-from bot.helper.exceptions import FIleNotFound, InvalidHash
+from bot.helper.exceptions import FIleNotFound, InvalidHash, Overloaded
+from bot.helper.tracing import span
 from bot.helper.index import get_files, posts_file, index_channel_files
-from bot.server.custom_dl import ByteStreamer
+from bot.server.admission import admission
+from bot.server.byte_ranges import multipart_body, multipart_heads, multipart_length, parse_range
+from bot.server.chunk_cache import CHUNK_SIZE
+from bot.server.custom_dl import get_streamer
+from bot.server.fair_share import fair_share, user_key
+from bot.server.header_cache import header_cache
+from bot.server.hls import hls_indexer
+from bot.server.http_cache import cache_control, entity_tag, not_modified, range_applies, validator_headers
+from bot.server.scheduler import scheduler
+from bot.server.stream_engine import stream_response
 from bot.server.render_template import render_page
 from bot.helper.cache import rm_cache
 
@@ -338,7 +349,7 @@ async def get_thumbnail(request):
         img = await get_image(chat_id, message_id)
     else:
         img = await get_image(chat_id, None)
-    response = web.FileResponse(img)
+    response = web.FileResponse(img, headers={"Cache-Control": cache_control(Telegram.THUMB_CACHE_MAX_AGE)})
     response.content_type = "image/jpeg"
     return response
 
@@ -368,6 +379,32 @@ async def stream_handler_watch(request: web.Request):
         return web.HTTPFound('/login')
 
 
+@routes.get(r'/hls/{chat_id:\d+}', allow_head=True)
+async def hls_playlist(request: web.Request):
+    try:
+        chat_id = request.match_info['chat_id']
+        message_id = request.query.get('id')
+        secure_hash = request.query.get('hash')
+        index = scheduler.pick(int(f"-100{chat_id}"), int(message_id))
+        tg_connect = get_streamer(index)
+        file_id = await tg_connect.get_file_properties(chat_id=int(f"-100{chat_id}"), message_id=int(message_id))
+        if file_id.unique_id[:6] != secure_hash:
+            raise InvalidHash
+        if (hls_index := await hls_indexer.get(tg_connect, file_id, index)) is None:
+            raise web.HTTPNotFound(text="This file has no fragment index to build a playlist from")
+        uri = f"/{chat_id}/{quote(file_id.file_name or 'video.mp4', safe='')}?id={message_id}&hash={secure_hash}"
+        return web.Response(text=hls_index.render(uri), content_type="application/vnd.apple.mpegurl", headers={"Cache-Control": cache_control(Telegram.STREAM_CACHE_MAX_AGE)})
+    except InvalidHash as e:
+        raise web.HTTPForbidden(text=e.message) from e
+    except FIleNotFound as e:
+        raise web.HTTPNotFound(text=e.message) from e
+    except web.HTTPException:
+        raise
+    except Exception as e:
+        logging.critical(e.with_traceback(None))
+        raise web.HTTPInternalServerError(text=str(e))
+
+
 @routes.get(r'/{chat_id:\d+}/{encoded_name}', allow_head=True)
 async def stream_handler(request: web.Request):
     try:
@@ -379,6 +416,8 @@ async def stream_handler(request: web.Request):
         return await media_streamer(request, int(chat_id), int(message_id), secure_hash)
     except InvalidHash as e:
         raise web.HTTPForbidden(text=e.message) from e
+    except Overloaded as e:
+        raise web.HTTPServiceUnavailable(text=e.message, headers={"Retry-After": str(e.retry_after)}) from e
     except FIleNotFound as e:
         db.delete_file(chat_id=chat_id, msg_id=message_id, hash=secure_hash)
         raise web.HTTPNotFound(text=e.message) from e
@@ -389,64 +428,90 @@ async def stream_handler(request: web.Request):
         raise web.HTTPInternalServerError(text=str(e))
 
 
-class_cache = {}
+
+async def get_stripes(chat_id: int, id: int, index: int) -> list:
+    """
+    Pick the least busy clients other than ``index`` to share the chunks of one
+    response, up to STRIPE_CLIENTS clients in total. Clients that cannot see
+    the message are skipped.
+    """
+    if Telegram.STRIPE_CLIENTS <= 1 or len(multi_clients) <= 1:
+        return []
+    candidates = [i for i in scheduler.rank(chat_id, id) if i != index][:Telegram.STRIPE_CLIENTS - 1]
+    streamers = [get_streamer(i) for i in candidates]
+    file_ids = await gather(*[streamer.get_file_properties(chat_id=chat_id, message_id=id) for streamer in streamers], return_exceptions=True)
+    stripes = []
+    for streamer, stripe_index, file_id in zip(streamers, candidates, file_ids):
+        if isinstance(file_id, Exception):
+            logging.debug(f"Client {stripe_index} can not stripe message {id}: {file_id}")
+            continue
+        stripes.append((streamer, stripe_index, file_id))
+    return stripes
 
 
 async def media_streamer(request: web.Request, chat_id: int, id: int, secure_hash: str):
-    range_header = request.headers.get("Range", 0)
+    if request.method == "HEAD":
+        return await serve_media(request, chat_id, id, secure_hash, scheduler.pick(chat_id, id))
+    # A revalidation that ends in 304 sends no body, so like HEAD it should not queue for a stream slot
+    if "If-None-Match" in request.headers or "If-Modified-Since" in request.headers:
+        if (response := await revalidate(request, chat_id, id, secure_hash)) is not None:
+            return response
+    range_header = request.headers.get("Range", "")
+    resume = bool(range_header) and not range_header.replace(" ", "").startswith("bytes=0-")
+    with span("admission"):
+        index = await admission.admit(scheduler.rank(chat_id, id), resume)
+    try:
+        return await serve_media(request, chat_id, id, secure_hash, index)
+    finally:
+        admission.release(index)
+
+
+async def revalidate(request: web.Request, chat_id: int, id: int, secure_hash: str):
+    """The 304 for a conditional GET whose copy is still current, or None when the body has to be sent."""
+    file_id = await get_streamer(scheduler.pick(chat_id, id)).get_file_properties(chat_id=chat_id, message_id=id)
+    if file_id.unique_id[:6] != secure_hash:
+        logging.debug(f"Invalid hash for message with ID {id}")
+        raise InvalidHash
+    etag = entity_tag(file_id.unique_id)
+    if not_modified(request, etag, file_id.date):
+        return web.Response(status=304, headers=validator_headers(etag, file_id.date, Telegram.STREAM_CACHE_MAX_AGE))
+    return None
+
 
-    index = min(work_loads, key=work_loads.get)
-    faster_client = multi_clients[index]
+async def serve_media(request: web.Request, chat_id: int, id: int, secure_hash: str, index: int):
+    range_header = request.headers.get("Range")
 
     if Telegram.MULTI_CLIENT:
         logging.info(f"Client {index} is now serving {request.remote}")
 
-    if faster_client in class_cache:
-        tg_connect = class_cache[faster_client]
-        logging.debug(f"Using cached ByteStreamer object for client {index}")
-    else:
-        logging.debug(f"Creating new ByteStreamer object for client {index}")
-        tg_connect = ByteStreamer(faster_client)
-        class_cache[faster_client] = tg_connect
+    tg_connect = get_streamer(index)
     logging.debug("before calling get_file_properties")
-    file_id = await tg_connect.get_file_properties(chat_id=chat_id, message_id=id)
+    with span("file"):
+        file_id = await tg_connect.get_file_properties(chat_id=chat_id, message_id=id)
     logging.debug("after calling get_file_properties")
 
     if file_id.unique_id[:6] != secure_hash:
         logging.debug(f"Invalid hash for message with ID {id}")
         raise InvalidHash
+    scheduler.assign(chat_id, id, index, file_id.dc_id)
 
     file_size = file_id.file_size
 
-    if range_header:
-        from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
-    else:
-        from_bytes = request.http_range.start or 0
-        until_bytes = (request.http_range.stop or file_size) - 1
+    etag = entity_tag(file_id.unique_id)
+    cache_headers = validator_headers(etag, file_id.date, Telegram.STREAM_CACHE_MAX_AGE)
+    if not_modified(request, etag, file_id.date):
+        return web.Response(status=304, headers=cache_headers)
 
-    if (until_bytes > file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
+    ranges = None
+    if range_header and range_applies(request, etag, file_id.date):
+        ranges = parse_range(range_header, file_size)
+    if ranges == []:
         return web.Response(
             status=416,
             body="416: Range not satisfiable",
             headers={"Content-Range": f"bytes */{file_size}"},
         )
 
-    chunk_size = 1024 * 1024
-    until_bytes = min(until_bytes, file_size - 1)
-
-    offset = from_bytes - (from_bytes % chunk_size)
-    first_part_cut = from_bytes - offset
-    last_part_cut = until_bytes % chunk_size + 1
-
-    req_length = until_bytes - from_bytes + 1
-    part_count = math.ceil(until_bytes / chunk_size) - \
-        math.floor(offset / chunk_size)
-    body = tg_connect.yield_file(
-        file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
-    )
-
     mime_type = file_id.mime_type
     file_name = file_id.file_name
     disposition = "attachment"
@@ -459,19 +524,39 @@ async def media_streamer(request: web.Request, chat_id: int, id: int, secure_has
                 file_name = f"{secrets.token_hex(2)}.unknown"
     else:
         if file_name:
-            mime_type = mimetypes.guess_type(file_id.file_name)
+            mime_type = mimetypes.guess_type(file_id.file_name)[0] or "application/octet-stream"
         else:
             mime_type = "application/octet-stream"
             file_name = f"{secrets.token_hex(2)}.unknown"
 
-    return web.Response(
-        status=206 if range_header else 200,
-        body=body,
-        headers={
-            "Content-Type": f"{mime_type}",
-            "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-            "Content-Length": str(req_length),
-            "Content-Disposition": f'{disposition}; filename="{file_name}"',
-            "Accept-Ranges": "bytes",
-        },
-    )
+    headers = {
+        "Content-Disposition": f'{disposition}; filename="{file_name}"',
+        "Accept-Ranges": "bytes",
+        **cache_headers,
+    }
+
+    # Every viewer logs in as the same USERNAME, so the address is what tells them apart
+    flow = fair_share.open(user_key(request), request.headers.get("Sec-Fetch-Dest"))
+    try:
+        if ranges and len(ranges) > 1:
+            boundary = secrets.token_hex(16)
+            heads, tail = multipart_heads(ranges, file_size, mime_type, boundary)
+            headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+            headers["Content-Length"] = str(multipart_length(ranges, heads, tail))
+            body = multipart_body(lambda start, end: header_cache.yield_file(tg_connect, file_id, index, start, end, flow=flow), ranges, heads, tail)
+            return await stream_response(request, web.StreamResponse(status=206, headers=headers), body, flow)
+
+        from_bytes, until_bytes = ranges[0] if ranges else (0, file_size - 1)
+        req_length = until_bytes - from_bytes + 1
+        with span("stripes"):
+            stripes = await get_stripes(chat_id, id, index) if req_length > CHUNK_SIZE and request.method != "HEAD" else []
+        body = header_cache.yield_file(tg_connect, file_id, index, from_bytes, until_bytes, stripes, flow)
+
+        headers["Content-Type"] = mime_type
+        headers["Content-Length"] = str(req_length)
+        if ranges:
+            headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
+        response = web.StreamResponse(status=206 if ranges else 200, headers=headers)
+        return await stream_response(request, response, body, flow)
+    finally:
+        fair_share.close(flow)